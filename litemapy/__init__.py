@@ -1,2 +1,2 @@
-from .schematic import Schematic, Region, BlockState, Entity, TileEntity
+from .schematic import Schematic, SchematicMetadata, Region, BlockState, Entity, TileEntity
 from .info import LITEMAPY_VERSION as __version__
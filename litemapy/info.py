@@ -1,6 +1,7 @@
 LITEMATIC_VERSION = 6
 LITEMATIC_SUBVERSION = 1
 SPONGE_VERSION = 2  # Sponge format version used by WorldEdit (https://github.com/SpongePowered/Schematic-Specification)
+SPONGE_SUPPORTED_VERSIONS = (2, 3)  # Sponge format versions that can be read and written
 MC_DATA_VERSION = 2975  # Minecraft 1.18.2 (https://minecraft.wiki/w/Data_version)
 DEFAULT_NAME = "Unnamed"  # Default name given to schematics and regions if unspecified
 LITEMAPY_NAME = "Litemapy"  # Used to identify schematic created with Litemapy in metadata
@@ -0,0 +1,617 @@
+import gzip
+import os
+import secrets
+import shutil
+import zlib
+from contextlib import contextmanager, nullcontext
+from io import SEEK_CUR, BufferedReader, RawIOBase
+from os import PathLike
+from struct import Struct, error as StructError
+from typing import Any, BinaryIO, Callable, Collection, ContextManager, Generator, Optional, Union
+
+import numpy as np
+from nbtlib import File
+from nbtlib.tag import Base, Byte, Short, Int, Long, Float, Double, String, List, Compound, \
+    ByteArray, IntArray, LongArray
+
+TAG_END = 0
+TAG_LIST = 9
+TAG_COMPOUND = 10
+TAG_LONG_ARRAY = 12
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+COMPRESSION_GZIP = "gzip"
+COMPRESSION_ZLIB = "zlib"
+COMPRESSION_NONE = "none"
+
+# Either the name of a built-in codec, or a function that wraps a binary stream in a compressing stream
+Compression = Union[str, Callable[[BinaryIO], BinaryIO]]
+
+# Either a filesystem path or a binary file object
+FileOrPath = Union[str, PathLike, BinaryIO]
+
+# Size of the payload of tags that have a fixed size, by tag id
+_FIXED_SIZES = {1: 1, 2: 2, 3: 4, 4: 8, 5: 4, 6: 8}
+# Size of the items of array tags, by tag id
+_ARRAY_ITEM_SIZES = {7: 1, 11: 4, 12: 8}
+
+_SKIP_BUFFER_SIZE = 1 << 16
+_WRITE_BUFFER_SIZE = 1 << 20
+
+
+def open_nbt_file(file_path: str) -> BinaryIO:
+    """
+    Opens an NBT file for reading, decompressing it on the fly if it is gzip or zlib compressed.
+    """
+    with open(file_path, "rb") as file:
+        header = file.read(2)
+    if header == GZIP_MAGIC:
+        return gzip.open(file_path, "rb")  # type: ignore[return-value]
+    if _is_zlib_header(header):
+        return BufferedReader(_ZlibReader(open(file_path, "rb"), close_source=True))  # type: ignore[return-value]
+    return open(file_path, "rb")
+
+
+def read_nbt_file(file: FileOrPath, byteorder: str = "big") -> File:
+    """
+    Reads an NBT file, decompressing it if it is gzip or zlib compressed.
+    This is equivalent to :func:`nbtlib.load`, but a lot faster on files that contain large arrays,
+    as arrays are read directly from the decompressed data without per element conversions.
+
+    :param file:        the filesystem path to the file to read,
+                        or a binary file object to read it from, which does not need to be seekable
+    :param byteorder:   endianness of NBT numbers (either "little" or "big")
+
+    :raises ValueError: if the root tag is not a compound or the data is malformed
+    :raises EOFError:   if the data is truncated
+    """
+    if _is_file_object(file):
+        return parse_nbt(decompress_nbt(file.read()), byteorder)  # type: ignore[union-attr]
+    with open_nbt_file(file) as stream:  # type: ignore[arg-type]
+        data = stream.read()
+    return parse_nbt(data, byteorder)
+
+
+def decompress_nbt(data: bytes) -> bytes:
+    """
+    Decompresses NBT data if it is gzip or zlib compressed, and returns it as is otherwise.
+
+    :raises EOFError:   if the compressed data is truncated
+    :raises ValueError: if the compressed data is corrupted
+    """
+    try:
+        if data[:2] == GZIP_MAGIC:
+            return gzip.decompress(data)
+        if _is_zlib_header(data[:2]):
+            decompressor = zlib.decompressobj()
+            decompressed = decompressor.decompress(data)
+            if not decompressor.eof:
+                raise EOFError("Compressed data ended before the end-of-stream marker was reached")
+            return decompressed
+    except (gzip.BadGzipFile, zlib.error) as e:
+        raise ValueError("Invalid compressed NBT data: {}".format(e)) from e
+    return data
+
+
+def parse_nbt(data: bytes, byteorder: str = "big") -> File:
+    """
+    Parses NBT data that is not compressed.
+    Arrays in the returned tags are copied out of the data, except region block states which are
+    read-only views of it, as they are large and usually dropped once decoded.
+
+    :param data:        the NBT data
+    :param byteorder:   endianness of NBT numbers (either "little" or "big")
+
+    :raises ValueError: if the root tag is not a compound or the data is malformed
+    :raises EOFError:   if the data is truncated
+    """
+    if not isinstance(data, bytes):
+        data = bytes(data)
+    return _BufferParser(data, byteorder).parse_root()
+
+
+@contextmanager
+def open_nbt_output(file: FileOrPath, compression: Compression = COMPRESSION_GZIP,
+                    compression_level: Optional[int] = None) -> Generator[BinaryIO, None, None]:
+    """
+    Opens an NBT file for writing, compressing it on the fly (see :func:`compress_stream`).
+    Binary file objects are written to as they are, and are left open.
+    They do not need to be seekable.
+    Paths are written to a temporary file next to the file they point to, following symbolic links,
+    which only replaces that file once everything was written, so a failure leaves any existing file untouched.
+    """
+    check_compression(compression, compression_level)
+    if _is_file_object(file):
+        with compress_stream(file, compression, compression_level) as stream:  # type: ignore[arg-type]
+            yield stream
+        return
+    # Write next to the target of symbolic links, so the link itself is kept
+    path = os.path.realpath(file)  # type: ignore[arg-type]
+    directory, name = os.path.split(path)
+    suffix = ".{}.tmp".format(secrets.token_hex(4))
+    if isinstance(name, bytes):
+        temporary_path = os.path.join(directory, b"." + name + os.fsencode(suffix))
+    else:
+        temporary_path = os.path.join(directory, "." + name + suffix)
+    try:
+        with open(temporary_path, "xb") as raw_file:
+            if os.path.exists(path):
+                shutil.copymode(path, temporary_path)
+            with compress_stream(raw_file, compression, compression_level) as stream:
+                yield stream
+        os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+
+def compress_stream(fileobj: BinaryIO, compression: Compression = COMPRESSION_GZIP,
+                    compression_level: Optional[int] = None) -> ContextManager[BinaryIO]:
+    """
+    Wraps a binary stream in a stream that compresses what is written to it.
+    Closing the returned stream flushes the compressed data, but does not close the wrapped stream
+    when using one of the built-in codecs.
+
+    :param fileobj:             the binary stream to write compressed data to
+    :param compression:         either :data:`COMPRESSION_GZIP`, :data:`COMPRESSION_ZLIB`, :data:`COMPRESSION_NONE`,
+                                or a function that wraps a binary stream in a compressing one,
+                                for instance to use a codec from an external library
+    :param compression_level:   the compression level of the gzip and zlib codecs, from 0 to 9,
+                                default is 9 for gzip and 6 for zlib
+
+    :raises ValueError: if the codec is unknown or the compression level is invalid
+    """
+    check_compression(compression, compression_level)
+    if callable(compression):
+        return compression(fileobj)  # type: ignore[return-value]
+    if compression == COMPRESSION_GZIP:
+        level = 9 if compression_level is None else compression_level
+        return gzip.GzipFile(fileobj=fileobj, mode="wb", compresslevel=level)  # type: ignore[return-value]
+    if compression == COMPRESSION_ZLIB:
+        level = zlib.Z_DEFAULT_COMPRESSION if compression_level is None else compression_level
+        return _ZlibWriter(fileobj, level)  # type: ignore[return-value]
+    return nullcontext(fileobj)
+
+
+def check_compression(compression: Compression, compression_level: Optional[int]) -> None:
+    """
+    Checks that a codec and compression level are valid (see :func:`compress_stream`).
+
+    :raises ValueError: if the codec is unknown or the compression level is invalid
+    """
+    if not callable(compression) and compression not in (COMPRESSION_GZIP, COMPRESSION_ZLIB, COMPRESSION_NONE):
+        raise ValueError("Unknown compression codec {}".format(compression))
+    if compression_level is None:
+        return
+    if callable(compression) or compression == COMPRESSION_NONE:
+        raise ValueError("Compression level can only be set for the gzip and zlib codecs")
+    if not 0 <= compression_level <= 9:
+        raise ValueError("Invalid compression level {}, should be between 0 and 9".format(compression_level))
+
+
+class CompressedFile(File):
+    """
+    An :class:`nbtlib.File` that is compressed with a configurable codec and level when saved
+    (see :func:`compress_stream`).
+    """
+
+    compression: Compression
+    compression_level: Optional[int]
+
+    def __init__(self, *args, compression: Compression = COMPRESSION_GZIP, compression_level: Optional[int] = None,
+                 **kwargs) -> None:
+        super().__init__(*args, gzipped=compression == COMPRESSION_GZIP, **kwargs)
+        self.compression = compression
+        self.compression_level = compression_level
+
+    def save(self, filename: Optional[str] = None, *, gzipped: Optional[bool] = None,
+             byteorder: Optional[str] = None) -> None:
+        if gzipped is not None and gzipped != self.gzipped:
+            # Explicitly asking for gzip or not overrides the codec, as with a regular nbtlib file
+            super().save(filename, gzipped=gzipped, byteorder=byteorder)
+            return
+        if filename is None:
+            filename = self.filename
+        if filename is None:
+            raise ValueError("No filename specified")
+        with open_nbt_output(filename, self.compression, self.compression_level) as fileobj:
+            self.write(fileobj, byteorder or self.byteorder)
+
+
+def compression_from_gzipped(compression: Optional[Compression], gzipped: bool) -> Compression:
+    """
+    Resolves the codec to use from the codec and legacy gzipped arguments of saving methods,
+    the codec taking precedence when it is set.
+    """
+    if compression is not None:
+        return compression
+    return COMPRESSION_GZIP if gzipped else COMPRESSION_NONE
+
+
+class _ZlibWriter:
+    """
+    A binary stream that writes data compressed in the zlib format to another stream.
+    """
+
+    def __init__(self, fileobj: BinaryIO, level: int) -> None:
+        self.__fileobj = fileobj
+        self.__compressor = zlib.compressobj(level)
+        self.closed = False
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError("write to closed file")
+        self.__fileobj.write(self.__compressor.compress(data))
+        return len(data) if isinstance(data, bytes) else memoryview(data).nbytes
+
+    def close(self) -> None:
+        if not self.closed:
+            self.__fileobj.write(self.__compressor.flush())
+            self.closed = True
+
+    def __enter__(self) -> '_ZlibWriter':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class _ZlibReader(RawIOBase):
+    """
+    A binary stream that decompresses zlib data read from another stream.
+    """
+
+    def __init__(self, fileobj: BinaryIO, close_source: bool = False) -> None:
+        super().__init__()
+        self.__fileobj = fileobj
+        self.__close_source = close_source
+        self.__decompressor = zlib.decompressobj()
+        self.__pending = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        size = len(buffer)
+        while not self.__pending:
+            if self.__decompressor.eof:
+                return 0
+            compressed = self.__decompressor.unconsumed_tail or self.__fileobj.read(_SKIP_BUFFER_SIZE)
+            if not compressed:
+                raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+            # Bound the decompressed size so a small compressed chunk cannot expand into a huge buffer
+            self.__pending = self.__decompressor.decompress(compressed, size)
+        read = min(size, len(self.__pending))
+        buffer[:read] = self.__pending[:read]
+        self.__pending = self.__pending[read:]
+        return read
+
+    def close(self) -> None:
+        if self.__close_source and not self.closed:
+            self.__fileobj.close()
+        super().close()
+
+
+def _is_file_object(file: FileOrPath) -> bool:
+    return not isinstance(file, (str, bytes, PathLike))
+
+
+def _is_zlib_header(header: bytes) -> bool:
+    # A zlib stream starts with a deflate method byte and a check byte that make the first two bytes a multiple of 31
+    return len(header) == 2 and header[0] & 0x0f == 8 and (header[0] << 8 | header[1]) % 31 == 0
+
+
+class NbtWriter:
+    """
+    Writes NBT data to a binary stream incrementally, one tag at a time,
+    so large structures do not need to be built and serialized in memory before being written.
+    Compounds are opened with :meth:`begin_compound` and closed with :meth:`end_compound`,
+    the root compound being the first one opened.
+    """
+
+    fileobj: BinaryIO
+    byteorder: str
+    __depth: int
+    __prefix: str
+
+    def __init__(self, fileobj: BinaryIO, byteorder: str = "big") -> None:
+        self.fileobj = fileobj
+        self.byteorder = byteorder
+        self.__depth = 0
+        self.__prefix = ">" if byteorder == "big" else "<"
+
+    def begin_compound(self, name: str = "") -> None:
+        """
+        Starts a compound tag, the following tags are written to it until :meth:`end_compound` is called.
+        """
+        self.__write_header(TAG_COMPOUND, name)
+        self.__depth += 1
+
+    def end_compound(self) -> None:
+        """
+        Ends the last compound tag that was started.
+
+        :raises ValueError: if there is no compound to end
+        """
+        if self.__depth <= 0:
+            raise ValueError("No NBT compound to end")
+        self.fileobj.write(bytes((TAG_END,)))
+        self.__depth -= 1
+
+    def write_tag(self, name: str, tag: Base) -> None:
+        """
+        Writes an nbtlib tag to the current compound.
+        """
+        self.__check_in_compound()
+        self.__write_header(tag.tag_id, name)
+        if isinstance(tag, np.ndarray):
+            self.__write_array(np.asarray(tag))
+        else:
+            tag.write(self.fileobj, self.byteorder)
+
+    def write_long_array(self, name: str, values: np.ndarray) -> None:
+        """
+        Writes a long array tag directly from a one dimensional array of 64 bits integers.
+        The array is converted to the output byte order in bounded chunks
+        instead of being copied as a whole.
+        """
+        self.__check_in_compound()
+        if values.dtype.itemsize != 8 or values.dtype.kind not in "iu":
+            raise ValueError("Long arrays can only be written from 64 bits integer arrays")
+        self.__write_header(LongArray.tag_id, name)
+        self.__write_array(values)
+
+    def __write_array(self, values: np.ndarray) -> None:
+        self.fileobj.write(_INT[self.byteorder].pack(len(values)))
+        dtype = values.dtype.newbyteorder(self.__prefix)
+        chunk_size = max(1, _WRITE_BUFFER_SIZE // max(1, values.dtype.itemsize))
+        for start in range(0, len(values), chunk_size):
+            chunk = values[start:start + chunk_size]
+            if chunk.dtype != dtype:
+                chunk = chunk.astype(dtype)
+            self.fileobj.write(np.ascontiguousarray(chunk).data)
+
+    def __write_header(self, tag_id: int, name: str) -> None:
+        encoded = name.encode("utf-8")
+        self.fileobj.write(_BYTE.pack(tag_id) + _USHORT[self.byteorder].pack(len(encoded)) + encoded)
+
+    def __check_in_compound(self) -> None:
+        if self.__depth <= 0:
+            raise ValueError("NBT tags can only be written inside a compound")
+
+
+def read_root_tags(fileobj: BinaryIO, names: Collection[str], byteorder: str = "big") -> dict[str, Base]:
+    """
+    Reads some entries of the root compound of an NBT stream.
+    Other entries are skipped without building any tag,
+    and reading stops as soon as all the requested entries have been found.
+
+    :param fileobj:     a binary stream positioned at the start of the NBT data
+    :param names:       the names of the root entries to read
+    :param byteorder:   endianness of NBT numbers (either "little" or "big")
+
+    :returns:           the requested entries that were found, by name
+
+    :raises ValueError: if the root tag is not a compound
+    """
+    if _read_byte(fileobj) != TAG_COMPOUND:
+        raise ValueError("The root NBT tag is not a compound")
+    _read_string(fileobj, byteorder)
+    remaining = set(names)
+    tags = {}
+    while remaining:
+        tag_id = _read_byte(fileobj)
+        if tag_id == TAG_END:
+            break
+        name = _read_string(fileobj, byteorder)
+        if name in remaining:
+            tags[name] = Base.all_tags[tag_id].parse(fileobj, byteorder)
+            remaining.remove(name)
+        else:
+            skip_tag(fileobj, tag_id, byteorder)
+    return tags
+
+
+def skip_tag(fileobj: BinaryIO, tag_id: int, byteorder: str = "big") -> None:
+    """
+    Skips the payload of a tag in an NBT stream, without building it.
+    """
+    if tag_id in _FIXED_SIZES:
+        _skip_bytes(fileobj, _FIXED_SIZES[tag_id])
+    elif tag_id in _ARRAY_ITEM_SIZES:
+        _skip_bytes(fileobj, _read_int(fileobj, byteorder) * _ARRAY_ITEM_SIZES[tag_id])
+    elif tag_id == 8:
+        _skip_bytes(fileobj, _read_ushort(fileobj, byteorder))
+    elif tag_id == TAG_LIST:
+        item_id = _read_byte(fileobj)
+        length = _read_int(fileobj, byteorder)
+        if item_id in _FIXED_SIZES:
+            _skip_bytes(fileobj, length * _FIXED_SIZES[item_id])
+        else:
+            for _ in range(length):
+                skip_tag(fileobj, item_id, byteorder)
+    elif tag_id == TAG_COMPOUND:
+        item_id = _read_byte(fileobj)
+        while item_id != TAG_END:
+            _skip_bytes(fileobj, _read_ushort(fileobj, byteorder))
+            skip_tag(fileobj, item_id, byteorder)
+            item_id = _read_byte(fileobj)
+    else:
+        raise ValueError("Invalid NBT tag id {}".format(tag_id))
+
+
+_BYTE = Struct("b")
+_USHORT = {"big": Struct(">H"), "little": Struct("<H")}
+_INT = {"big": Struct(">i"), "little": Struct("<i")}
+
+
+def _read_exactly(fileobj: BinaryIO, size: int) -> bytes:
+    data = fileobj.read(size)
+    if len(data) != size:
+        raise EOFError("Unexpected end of NBT data")
+    return data
+
+
+def _read_byte(fileobj: BinaryIO) -> int:
+    return _BYTE.unpack(_read_exactly(fileobj, 1))[0]
+
+
+def _read_ushort(fileobj: BinaryIO, byteorder: str) -> int:
+    return _USHORT[byteorder].unpack(_read_exactly(fileobj, 2))[0]
+
+
+def _read_int(fileobj: BinaryIO, byteorder: str) -> int:
+    return _INT[byteorder].unpack(_read_exactly(fileobj, 4))[0]
+
+
+def _read_string(fileobj: BinaryIO, byteorder: str) -> str:
+    return _read_exactly(fileobj, _read_ushort(fileobj, byteorder)).decode("utf-8", "replace")
+
+
+def _skip_bytes(fileobj: BinaryIO, size: int) -> None:
+    if fileobj.seekable():
+        fileobj.seek(size, SEEK_CUR)
+        return
+    while size > 0:
+        size -= len(_read_exactly(fileobj, min(size, _SKIP_BUFFER_SIZE)))
+
+
+class _BufferParser:
+    """
+    Parses NBT tags from a buffer that holds the whole NBT data,
+    reading numbers with precompiled structs and arrays with :func:`numpy.frombuffer`.
+    Arrays are copied so small tags kept around do not hold on to the whole buffer,
+    except for region block states which are only views of it.
+    """
+
+    data: bytes
+    offset: int
+    byteorder: str
+    __prefix: str
+    __numbers: dict[int, tuple[type, Struct]]
+    __ushort: Struct
+    __int: Struct
+    __parsers: dict[int, Callable[[], Base]]
+
+    def __init__(self, data: bytes, byteorder: str = "big") -> None:
+        self.data = data
+        self.offset = 0
+        self.byteorder = byteorder
+        self.__prefix = ">" if byteorder == "big" else "<"
+        self.__numbers = {
+            tag_id: (tag_type, Struct(self.__prefix + code)) for tag_id, (tag_type, code) in _NUMBER_TAGS.items()
+        }
+        self.__ushort = Struct(self.__prefix + "H")
+        self.__int = Struct(self.__prefix + "i")
+        self.__parsers = {tag_id: self.__number_parser(tag_id) for tag_id in _NUMBER_TAGS}
+        self.__parsers.update({
+            7: lambda: self.__parse_array(ByteArray),
+            8: self.__parse_string,
+            9: self.__parse_list,
+            10: self.__parse_compound,
+            11: lambda: self.__parse_array(IntArray),
+            12: lambda: self.__parse_array(LongArray),
+        })
+
+    def parse_root(self) -> File:
+        try:
+            if self.__read_byte() != TAG_COMPOUND:
+                raise ValueError("The root NBT tag is not a compound")
+            root_name = self.__read_string()
+            return File(self.__parse_compound(), byteorder=self.byteorder, root_name=root_name)
+        except StructError as e:
+            raise EOFError("Unexpected end of NBT data") from e
+
+    def __parse(self, tag_id: int) -> Base:
+        try:
+            parser = self.__parsers[tag_id]
+        except KeyError:
+            raise ValueError("Invalid NBT tag id {}".format(tag_id)) from None
+        return parser()
+
+    def __number_parser(self, tag_id: int) -> Callable[[], Base]:
+        tag_type, struct = self.__numbers[tag_id]
+
+        def parse() -> Base:
+            value = struct.unpack_from(self.data, self.offset)[0]
+            self.offset += struct.size
+            return tag_type(value)
+        return parse
+
+    def __parse_string(self) -> String:
+        return String(self.__read_string())
+
+    def __parse_array(self, tag_type: type, copy: bool = True) -> Any:
+        length = self.__read_int()
+        dtype = tag_type.item_type[self.byteorder]
+        values = self.__read_numbers(dtype, length)
+        if copy:
+            values = values.copy()
+        return tag_type(values, byteorder=self.byteorder)
+
+    def __parse_list(self) -> List:
+        item_id = self.__read_byte()
+        length = self.__read_int()
+        if item_id not in Base.all_tags:
+            raise ValueError("Invalid NBT tag id {}".format(item_id))
+        if length <= 0:
+            return List[Base.all_tags[item_id]]()
+        if item_id in self.__numbers:
+            tag_type, struct = self.__numbers[item_id]
+            values = self.__read_numbers(np.dtype(self.__prefix + struct.format[1:]), length)
+            return List[tag_type](tag_type(value) for value in values.tolist())
+        items = [self.__parse(item_id) for _ in range(length)]
+        return List[Base.all_tags[item_id]](items)
+
+    def __parse_compound(self) -> Compound:
+        compound = Compound()
+        tag_id = self.__read_byte()
+        while tag_id != TAG_END:
+            name = self.__read_string()
+            if tag_id == TAG_LONG_ARRAY and name == "BlockStates":
+                compound[name] = self.__parse_array(LongArray, copy=False)
+            else:
+                compound[name] = self.__parse(tag_id)
+            tag_id = self.__read_byte()
+        return compound
+
+    def __read_numbers(self, dtype: np.dtype, count: int) -> np.ndarray:
+        if count < 0:
+            raise ValueError("Negative NBT array length")
+        end = self.offset + count * dtype.itemsize
+        if end > len(self.data):
+            raise EOFError("Unexpected end of NBT data")
+        values = np.frombuffer(self.data, dtype=dtype, count=count, offset=self.offset)
+        self.offset = end
+        return values
+
+    def __read_byte(self) -> int:
+        value = _BYTE.unpack_from(self.data, self.offset)[0]
+        self.offset += 1
+        return value
+
+    def __read_int(self) -> int:
+        value = self.__int.unpack_from(self.data, self.offset)[0]
+        self.offset += 4
+        return value
+
+    def __read_string(self) -> str:
+        length = self.__ushort.unpack_from(self.data, self.offset)[0]
+        start = self.offset + 2
+        self.offset = start + length
+        if self.offset > len(self.data):
+            raise EOFError("Unexpected end of NBT data")
+        return self.data[start:self.offset].decode("utf-8", "replace")
+
+
+# Tags holding a single number, with their struct format
+_NUMBER_TAGS = {
+    1: (Byte, "b"),
+    2: (Short, "h"),
+    3: (Int, "i"),
+    4: (Long, "q"),
+    5: (Float, "f"),
+    6: (Double, "d"),
+}
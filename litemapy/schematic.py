@@ -1,17 +1,31 @@
-from math import ceil, log
+import asyncio
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from os import cpu_count
+from threading import Lock
+from io import BytesIO
+from math import ceil
+from multiprocessing.shared_memory import SharedMemory
+from tempfile import TemporaryFile
 from time import time
 
 import nbtlib
 import numpy as np
-from nbtlib.tag import Short, Byte, Int, Long, Double, String, List, Compound, ByteArray, IntArray
+from nbtlib.tag import Short, Int, Long, Double, String, List, Compound, ByteArray, IntArray, LongArray
 from typing_extensions import deprecated
 
-from typing import Any, Generator, Callable, Optional
+from typing import Any, Generator, Callable, Iterable, Optional, Sequence, Union
 
 from .deprecation import deprecated_name
 from .info import *
 from .minecraft import BlockState, Entity, TileEntity, RequiredKeyMissingException
-from .storage import LitematicaBitArray, DiscriminatingDictionary
+from .nbtio import NbtWriter, Compression, CompressedFile, FileOrPath, check_compression, compression_from_gzipped, \
+    open_nbt_file, open_nbt_output, read_nbt_file, read_root_tags
+from .storage import LitematicaBitArray, DiscriminatingDictionary, SectionedBlockArray, decode_varints, \
+    encode_varints
+
+
+RegionSelection = Union[Iterable[str], Callable[[str], bool]]
 
 
 class Schematic:
@@ -64,30 +78,72 @@ class Schematic:
         self.lm_subversion = lm_subversion
         self.__preview = IntArray([])
 
-    def save(self, file_path: str, update_meta: bool = True, save_soft: bool = True, gzipped: bool = True,
-             byteorder: str = 'big') -> None:
+    def save(self, file_path: FileOrPath, update_meta: bool = True, save_soft: bool = True, gzipped: bool = True,
+             byteorder: str = 'big', workers: Optional[int] = None, compression: Optional[Compression] = None,
+             compression_level: Optional[int] = None) -> None:
         """
         Save this schematic to a file.
+        When saving to a path, an existing file is only replaced once the schematic was fully written.
 
-        :param file_path:   the filesystem path the schematic should be saved to
+        :param file_path:   the filesystem path the schematic should be saved to,
+                            or a binary file object to write it to, which does not need to be seekable
+                            and is left open
         :param update_meta: whether to update the schematic's metadata before saving
                             (see :func:`~litemapy.Schematic.update_metadata`)
         :param save_soft:   whether to add an entry to the metadata indicating the schematic was created with Litemapy
         :param gzipped:     whether to compress the NBT content with gzip (this is the normal behavior)
         :param byteorder:   endianness of NBT numbers (either "little" or "big", default is "big")
+        :param workers:     a number of worker processes to encode regions in parallel (see :func:`Schematic.to_nbt`)
+        :param compression: the codec used to compress the NBT content, overrides gzipped when set
+                            (see :func:`litemapy.nbtio.compress_stream`)
+        :param compression_level:   the compression level of the gzip and zlib codecs, from 0 (fastest) to 9 (smallest)
 
-        :raises ValueError: if this schematic does not have any region
+        :raises ValueError: if this schematic does not have any region, or the compression settings are invalid
         """
+        if len(self.__regions) < 1:
+            raise ValueError("Empty schematic does not have any regions")
         if update_meta:
             self.update_metadata()
-        f = nbtlib.File(self.to_nbt(save_soft=save_soft), gzipped=gzipped, byteorder=byteorder)
-        f.save(file_path)
+        compression = compression_from_gzipped(compression, gzipped)
+        with open_nbt_output(file_path, compression, compression_level) as f:
+            self.__write_nbt(NbtWriter(f, byteorder), save_soft, workers)
 
-    def to_nbt(self, save_soft: bool = True) -> Compound:
+    def to_bytes(self, update_meta: bool = True, save_soft: bool = True, gzipped: bool = True,
+                 byteorder: str = 'big', workers: Optional[int] = None, compression: Optional[Compression] = None,
+                 compression_level: Optional[int] = None) -> bytes:
+        """
+        Save this schematic to bytes, as they would be written to a file by :func:`~litemapy.Schematic.save`.
+        Arguments are the same as for :func:`~litemapy.Schematic.save`.
+
+        :raises ValueError: if this schematic does not have any region, or the compression settings are invalid
+        """
+        buffer = BytesIO()
+        self.save(buffer, update_meta=update_meta, save_soft=save_soft, gzipped=gzipped, byteorder=byteorder,
+                  workers=workers, compression=compression, compression_level=compression_level)
+        return buffer.getvalue()
+
+    async def asave(self, file_path: FileOrPath, executor: Optional[Executor] = None, **kwargs) -> None:
+        """
+        Save this schematic to a file without blocking the event loop.
+        Encoding and compression run in an executor, the schematic should not be modified until this completes.
+        Other arguments are the same as for :func:`~litemapy.Schematic.save`.
+
+        :param file_path:   the filesystem path the schematic should be saved to, or a binary file object
+        :param executor:    the executor to run the work in,
+                            defaults to a thread pool shared by asynchronous methods which bounds their concurrency
+
+        :raises ValueError: if this schematic does not have any region, or the compression settings are invalid
+        """
+        await _run_in_executor(executor, self.save, file_path, **kwargs)
+
+    def to_nbt(self, save_soft: bool = True, workers: Optional[int] = None) -> Compound:
         """
         Write the schematic to an NBT tag.
 
         :param save_soft:   whether to add an entry to the metadata indicating the schematic was created with Litemapy
+        :param workers:     a number of worker processes to encode regions in parallel.
+                            Regions are encoded in the current process by default,
+                            and always are when they are sparse, memory-mapped or lazy regions that were not decoded.
 
         :rtype: ~nbtlib.tag.Compound
 
@@ -95,6 +151,49 @@ class Schematic:
         """
         if len(self.__regions) < 1:
             raise ValueError("Empty schematic does not have any regions")
+        root = self.__header_nbt(save_soft)
+        block_states = self.__encode_in_parallel(workers)
+        regs = Compound()
+        for name, region in self.regions.items():
+            tag = region._to_nbt_without_block_states()
+            if name in block_states:
+                tag["BlockStates"] = block_states[name]
+            else:
+                tag["BlockStates"] = region._pack_block_states()._to_nbt_long_array()
+            regs[name] = tag
+        root["Regions"] = regs
+        return root
+
+    def __write_nbt(self, writer: NbtWriter, save_soft: bool, workers: Optional[int]) -> None:
+        # Streams the same tags as to_nbt, one region at a time,
+        # writing packed block states straight from their array
+        block_states = self.__encode_in_parallel(workers)
+        writer.begin_compound()
+        for key, tag in self.__header_nbt(save_soft).items():
+            writer.write_tag(key, tag)
+        writer.begin_compound("Regions")
+        for name, region in self.regions.items():
+            writer.begin_compound(name)
+            for key, tag in region._to_nbt_without_block_states().items():
+                writer.write_tag(key, tag)
+            if name in block_states:
+                writer.write_tag("BlockStates", block_states[name])
+            else:
+                writer.write_long_array("BlockStates", region._pack_block_states().array)
+            writer.end_compound()
+        writer.end_compound()
+        writer.end_compound()
+
+    def __encode_in_parallel(self, workers: Optional[int]) -> dict[str, LongArray]:
+        if workers is None or workers <= 1:
+            return {}
+        dense = {name: region for name, region in self.regions.items() if region._is_dense_in_memory()}
+        if len(dense) <= 1:
+            return {}
+        return _encode_regions_in_parallel(dense, workers)
+
+    def __header_nbt(self, save_soft: bool) -> Compound:
+        # Everything but the regions
         root = Compound()
         root["Version"] = Int(self.lm_version)
         root["SubVersion"] = Int(self.lm_subversion)
@@ -117,23 +216,99 @@ class Schematic:
         meta["TotalVolume"] = Int(sum([reg.volume() for reg in self.regions.values()]))
         meta['PreviewImageData'] = self.__preview
         root["Metadata"] = meta
-        regs = Compound()
-        for name, region in self.regions.items():
-            regs[name] = region.to_nbt()
-        root["Regions"] = regs
         return root
 
+    def to_sponge_nbt(self, mc_version: Optional[int] = None, gzipped: bool = True, endianness: str = 'big',
+                      compression: Optional[Compression] = None, compression_level: Optional[int] = None,
+                      version: int = SPONGE_VERSION) -> nbtlib.nbt.File:
+        """
+        Returns the schematic as an NBT Compound file that conforms to the Sponge Schematic Format
+        used by mods like WorldEdit, with all its regions merged into a single block volume the size of the schematic.
+        Where regions overlap, blocks from regions that come later in :attr:`regions` take precedence,
+        except for air.
+        Other arguments are the same as for :func:`~litemapy.Region.to_sponge_nbt`.
+
+        :param mc_version:  Minecraft data version that is being emulated, defaults to the schematic's
+
+        :returns:           The schematic represented as a Sponge Schematic NBT Compound file.
+
+        :raises ValueError: if this schematic does not have any region, or the version is not supported
+        """
+        return self.as_region().to_sponge_nbt(mc_version=self.mc_version if mc_version is None else mc_version,
+                                              gzipped=gzipped, endianness=endianness, compression=compression,
+                                              compression_level=compression_level, version=version)
+
+    def as_region(self) -> 'Region':
+        """
+        Merges all the regions of this schematic into a single new region the size of the schematic,
+        positioned at the minimum corner of the schematic.
+        Where regions overlap, blocks from regions that come later in :attr:`regions` take precedence,
+        except for air. Entities and tile entities are copied.
+
+        :raises ValueError: if this schematic does not have any region
+        """
+        if len(self.__regions) < 1:
+            raise ValueError("Empty schematic does not have any regions")
+        palette: list[BlockState] = [AIR]
+        palette_index: dict[BlockState, int] = {AIR: 0}
+        luts = []
+        for region in self.__regions.values():
+            lut = np.zeros(len(region.palette), dtype=np.int64)
+            for i, block in enumerate(region.palette):
+                if block not in palette_index:
+                    palette_index[block] = len(palette)
+                    palette.append(block)
+                lut[i] = palette_index[block]
+            luts.append(lut)
+        dtype = _block_dtype(len(palette))
+        blocks = np.zeros((self.width, self.height, self.length), dtype=dtype)
+        entities: list[Entity] = []
+        tile_entities: list[TileEntity] = []
+        for region, lut in zip(self.__regions.values(), luts):
+            region_blocks, _ = region.to_array()
+            offset = (region.min_schem_x() - self.__x_min, region.min_schem_y() - self.__y_min,
+                      region.min_schem_z() - self.__z_min)
+            box = tuple(slice(start, start + size) for start, size in zip(offset, region_blocks.shape))
+            np.copyto(blocks[box], lut.astype(dtype)[region_blocks], where=region_blocks != 0)
+            # Entity positions are relative to the region's origin, which is not always its minimum corner
+            origin = (region.x - self.__x_min, region.y - self.__y_min, region.z - self.__z_min)
+            for entity in region.entities:
+                copy = Entity(Compound(entity.data))
+                copy.position = tuple(coord + shift for coord, shift in zip(entity.position, origin))
+                entities.append(copy)
+            for tile_entity in region.tile_entities:
+                copy = TileEntity(Compound(tile_entity.data))
+                copy.position = tuple(coord + shift for coord, shift in zip(tile_entity.position, offset))
+                tile_entities.append(copy)
+        merged = Region.from_array(blocks, palette, self.__x_min, self.__y_min, self.__z_min)
+        merged.entities.extend(entities)
+        merged.tile_entities.extend(tile_entities)
+        return merged
+
     @deprecated_name("fromnbt")
     @staticmethod
-    def from_nbt(nbt: Compound) -> 'Schematic':
+    def from_nbt(nbt: Compound, sparse: bool = False, scratch_dir: Optional[str] = None,
+                 lazy: bool = False, regions: Optional[RegionSelection] = None,
+                 workers: Optional[int] = None) -> 'Schematic':
         """
         Read a schematic from an NBT tag.
 
-        :param nbt: a schematic serialized as an NBT tag
+        :param nbt:         a schematic serialized as an NBT tag
+        :param sparse:      whether regions should store their blocks in sections (see :class:`Region`)
+        :param scratch_dir: a directory to store region blocks in memory-mapped files (see :class:`Region`)
+        :param lazy:        whether to only decode regions the first time their content is accessed
+                            (see :func:`Region.from_nbt`)
+        :param regions:     the names of the regions to read, or a function that tells whether a region should be read
+                            given its name. Other regions are left out of the schematic, but are still taken
+                            into account when checking the size in the metadata. All regions are read by default.
+        :param workers:     a number of worker processes to decode regions in parallel.
+                            Regions are decoded in the current process by default,
+                            and always are when they are read as sparse, memory-mapped or lazy regions.
 
         :rtype:     Schematic
 
         :raises CorruptedSchematicError: if the schematic tag is malformed
+        :raises KeyError:                if a region that should be read is not in the schematic
         """
         meta: Compound = nbt["Metadata"]
         lm_version: Int = nbt["Version"]
@@ -145,11 +320,28 @@ class Schematic:
         author = str(meta["Author"])
         name = str(meta["Name"])
         desc = str(meta["Description"])
-        regions: dict[str, 'Region'] = {}
-        for key, value in nbt["Regions"].items():
-            reg = Region.from_nbt(value)
-            regions[str(key)] = reg
-        schematic = Schematic(name=name, author=author, description=desc, regions=regions,
+        region_tags: Compound = nbt["Regions"]
+        selected = _region_selector(regions, region_tags.keys())
+        parallel = workers is not None and workers > 1 and not (sparse or lazy or scratch_dir is not None)
+        read_regions: dict[str, Optional['Region']] = {}
+        parallel_tags: dict[str, Compound] = {}
+        skipped: list[str] = []
+        for key, value in region_tags.items():
+            key = str(key)
+            if not selected(key):
+                # Only the position and size of skipped regions are read, to check the metadata against them
+                read_regions[key] = Region.from_nbt(value, lazy=True)
+                skipped.append(key)
+            elif parallel:
+                read_regions[key] = None
+                parallel_tags[key] = value
+            else:
+                read_regions[key] = Region.from_nbt(value, sparse=sparse, scratch_dir=scratch_dir, lazy=lazy)
+        if len(parallel_tags) > 1:
+            read_regions.update(_decode_regions_in_parallel(parallel_tags, workers))
+        else:
+            read_regions.update({key: Region.from_nbt(value) for key, value in parallel_tags.items()})
+        schematic = Schematic(name=name, author=author, description=desc, regions=read_regions,
                               lm_version=lm_version, lm_subversion=lm_subversion,
                               mc_version=mc_version)
         if schematic.width != width:
@@ -167,6 +359,8 @@ class Schematic:
             raise CorruptedSchematicError("Number of regions in metadata does not match the number of parsed regions")
         if 'PreviewImageData' in meta.keys():
             schematic.__preview = meta['PreviewImageData']
+        for key in skipped:
+            del schematic.regions[key]
         return schematic
 
     @deprecated_name("updatemeta")
@@ -177,18 +371,85 @@ class Schematic:
         self.modified = round(time() * 1000)
 
     @staticmethod
-    def load(file_path) -> 'Schematic':
+    def load(file_path: FileOrPath, sparse: bool = False, scratch_dir: Optional[str] = None, lazy: bool = False,
+             regions: Optional[RegionSelection] = None, workers: Optional[int] = None) -> 'Schematic':
         """
         Read a schematic from a file.
 
-        :param file_path:   the filesystem path to the file to load
+        :param file_path:   the filesystem path to the file to load,
+                            or a binary file object to read it from, which does not need to be seekable
+        :param sparse:      whether regions should store their blocks in sections (see :class:`Region`)
+        :param scratch_dir: a directory to store region blocks in memory-mapped files (see :class:`Region`)
+        :param lazy:        whether to only decode regions the first time their content is accessed,
+                            which makes loading a lot faster when only the metadata or a few regions are needed.
+                            Errors in a region's content are then only raised when it gets decoded.
+        :param regions:     the names of the regions to read, or a function that tells whether a region should be read
+                            given its name (see :func:`Schematic.from_nbt`). All regions are read by default.
+        :param workers:     a number of worker processes to decode regions in parallel (see :func:`Schematic.from_nbt`)
 
         :rtype:             Schematic
 
         :raises CorruptedSchematicError: if the schematic file is malformed in any way
+        :raises KeyError:                if a region that should be read is not in the schematic
+        """
+        try:
+            nbt = read_nbt_file(file_path)
+        except (ValueError, EOFError) as e:
+            raise CorruptedSchematicError("Invalid NBT data: {}".format(e)) from e
+        return Schematic.from_nbt(nbt, sparse=sparse, scratch_dir=scratch_dir, lazy=lazy, regions=regions,
+                                  workers=workers)
+
+    @staticmethod
+    def from_bytes(data: bytes, sparse: bool = False, scratch_dir: Optional[str] = None, lazy: bool = False,
+                   regions: Optional[RegionSelection] = None, workers: Optional[int] = None) -> 'Schematic':
         """
-        nbt = nbtlib.File.load(file_path, True)
-        return Schematic.from_nbt(nbt)
+        Read a schematic from the content of a file, compressed or not.
+        Arguments are the same as for :func:`~litemapy.Schematic.load`.
+
+        :rtype:             Schematic
+
+        :raises CorruptedSchematicError: if the schematic data is malformed in any way
+        :raises KeyError:                if a region that should be read is not in the schematic
+        """
+        return Schematic.load(BytesIO(data), sparse=sparse, scratch_dir=scratch_dir, lazy=lazy, regions=regions,
+                              workers=workers)
+
+    @staticmethod
+    async def aload(file_path: FileOrPath, executor: Optional[Executor] = None, **kwargs) -> 'Schematic':
+        """
+        Read a schematic from a file without blocking the event loop.
+        Decompression, parsing and decoding run in an executor.
+        Other arguments are the same as for :func:`~litemapy.Schematic.load`.
+
+        :param file_path:   the filesystem path to the file to load, or a binary file object
+        :param executor:    the executor to run the work in,
+                            defaults to a thread pool shared by asynchronous methods which bounds their concurrency
+
+        :rtype:             Schematic
+
+        :raises CorruptedSchematicError: if the schematic file is malformed in any way
+        """
+        return await _run_in_executor(executor, Schematic.load, file_path, **kwargs)
+
+    @staticmethod
+    def read_metadata(file_path: str) -> 'SchematicMetadata':
+        """
+        Read the metadata of a schematic file without loading its regions.
+        Only the metadata and version tags are parsed, the regions are skipped over,
+        which makes this a lot faster than :func:`~litemapy.Schematic.load` when only the metadata is needed.
+
+        :param file_path:   the filesystem path to the file to read
+
+        :rtype:             SchematicMetadata
+
+        :raises CorruptedSchematicError: if the schematic metadata is malformed
+        """
+        with open_nbt_file(file_path) as file:
+            try:
+                nbt = read_root_tags(file, SchematicMetadata.ROOT_TAGS)
+            except (ValueError, EOFError) as e:
+                raise CorruptedSchematicError("Invalid NBT data: {}".format(e)) from e
+        return SchematicMetadata.from_nbt(Compound(nbt))
 
     def _can_add_region(self, name: str, region: 'Region') -> tuple[bool, str]:
         if type(name) != str:
@@ -300,6 +561,67 @@ class Schematic:
         self.__preview = value
 
 
+class SchematicMetadata:
+    """
+    The metadata of a schematic file, as read by :func:`~litemapy.Schematic.read_metadata`.
+    Sizes, block and region counts are those recorded in the file and are not checked against its regions.
+    """
+
+    ROOT_TAGS = ("Metadata", "Version", "SubVersion", "MinecraftDataVersion")
+
+    name: str
+    author: str
+    description: str
+    software: Optional[str]
+    width: int
+    height: int
+    length: int
+    region_count: Optional[int]
+    total_blocks: Optional[int]
+    total_volume: Optional[int]
+    created: int
+    modified: int
+    lm_version: int
+    lm_subversion: int
+    mc_version: int
+    preview: IntArray
+
+    @staticmethod
+    def from_nbt(nbt: Compound) -> 'SchematicMetadata':
+        """
+        Read schematic metadata from the root tag of a schematic.
+        The root tag does not need to contain the regions.
+
+        :param nbt: a schematic serialized as an NBT tag
+
+        :rtype:     SchematicMetadata
+
+        :raises CorruptedSchematicError: if the metadata or version tags are missing
+        """
+        try:
+            meta: Compound = nbt["Metadata"]
+            metadata = SchematicMetadata()
+            metadata.lm_version = int(nbt["Version"])
+            metadata.lm_subversion = int(nbt.get("SubVersion", 0))
+            metadata.mc_version = int(nbt["MinecraftDataVersion"])
+            metadata.name = str(meta["Name"])
+            metadata.author = str(meta["Author"])
+            metadata.description = str(meta["Description"])
+            metadata.software = str(meta["Software"]) if "Software" in meta else None
+            metadata.width = int(meta["EnclosingSize"]["x"])
+            metadata.height = int(meta["EnclosingSize"]["y"])
+            metadata.length = int(meta["EnclosingSize"]["z"])
+            metadata.region_count = int(meta["RegionCount"]) if "RegionCount" in meta else None
+            metadata.total_blocks = int(meta["TotalBlocks"]) if "TotalBlocks" in meta else None
+            metadata.total_volume = int(meta["TotalVolume"]) if "TotalVolume" in meta else None
+            metadata.created = int(meta["TimeCreated"])
+            metadata.modified = int(meta["TimeModified"])
+            metadata.preview = meta.get("PreviewImageData", IntArray([]))
+        except KeyError as e:
+            raise CorruptedSchematicError("Missing schematic metadata entry {}".format(e)) from e
+        return metadata
+
+
 class Region:
     """
     Represents a schematic region.
@@ -311,13 +633,21 @@ class Region:
     __height: int
     __length: int
     __palette: list[BlockState]
-    __blocks: np.ndarray[np.uint32, Any]  # TODO replace any with the right shape when numpy supports its
+    __palette_index: dict[BlockState, int]
+    __palette_dirty: bool
+    __blocks: Union[np.ndarray[Any, Any], SectionedBlockArray]  # Unsigned integers just large enough for the palette
+    __sparse: bool
+    __scratch_dir: Optional[str]
+    __pending_nbt: Optional[Compound]  # Raw NBT of lazy regions that have not been decoded yet
     __entities: list[Entity]
     __block_ticks: list[Compound]
     __fluid_ticks: list[Compound]
     __tile_entities: list[TileEntity]
+    # Biomes read from Sponge v3 schematics, as sponge palette indices in XYZ order and the biome names they refer to
+    __biomes: Optional[tuple[np.ndarray, tuple[str, ...]]] = None
 
-    def __init__(self, x, y, z, width, height, length) -> None:
+    def __init__(self, x, y, z, width, height, length, sparse: bool = False,
+                 scratch_dir: Optional[str] = None) -> None:
         """
         :param x:       the X coordinate of the region in the schematic
         :param y:       the Y coordinate of the region in the schematic
@@ -325,15 +655,27 @@ class Region:
         :param width:   the size of the region along the x-axis (can be negative!)
         :param height:  the size of the region along the y-axis (can be negative!)
         :param length:  the size of the region along the z-axis (can be negative!)
+        :param sparse:  whether to store blocks in 16x16x16 sections that are only allocated when they contain
+                        something else than air, which uses a lot less memory for regions that are mostly empty
+        :param scratch_dir: if set, blocks are stored in a memory-mapped scratch file created in that directory,
+                            letting the operating system page them in and out of memory for regions too large
+                            to fit in RAM. The file is deleted automatically.
 
-        :raises ValueError: if either width, height or length is 0
+        :raises ValueError: if either width, height or length is 0, or both sparse and scratch_dir are set
         """
         if width == 0 or height == 0 or length == 0:
             raise ValueError("Region dimensions cannot be 0")
+        if sparse and scratch_dir is not None:
+            raise ValueError("Sparse regions cannot be stored in a scratch file")
         self.__x, self.__y, self.__z = x, y, z
         self.__width, self.__height, self.__length = width, height, length
         self.__palette = [AIR, ]
-        self.__blocks = np.zeros((abs(width), abs(height), abs(length)), dtype=np.uint32)
+        self.__palette_index = {AIR: 0}
+        self.__palette_dirty = False
+        self.__sparse = sparse
+        self.__scratch_dir = scratch_dir
+        self.__pending_nbt = None
+        self.__blocks = self.__allocate_blocks()
         self.__entities = []
         self.__tile_entities = []
         self.__block_ticks = []
@@ -344,7 +686,12 @@ class Region:
         Write this region to an NBT tag.
 
         """
+        root = self._to_nbt_without_block_states()
+        root["BlockStates"] = self._pack_block_states()._to_nbt_long_array()
+        return root
 
+    def _to_nbt_without_block_states(self) -> Compound:
+        # Block states are written separately when streaming a schematic or encoding it with worker processes
         self._optimize_palette()
 
         root = Compound()
@@ -371,23 +718,23 @@ class Region:
         root["PendingBlockTicks"] = List[Compound](self.__block_ticks)
         root["PendingFluidTicks"] = List[Compound](self.__fluid_ticks)
 
-        arr = LitematicaBitArray(self.volume(), self.__get_needed_nbits())
-        for x in range(abs(self.__width)):
-            for y in range(abs(self.__height)):
-                for z in range(abs(self.__length)):
-                    ind = (y * abs(self.__width * self.__length)) + z * abs(self.__width) + x
-                    arr[ind] = int(self.__blocks[x, y, z])
-        root["BlockStates"] = arr._to_nbt_long_array()
-
         return root
 
+    def _pack_block_states(self) -> LitematicaBitArray:
+        self._optimize_palette()
+        arr = LitematicaBitArray(self.volume(), self.__get_needed_nbits())
+        _pack_region_blocks(self.__blocks, arr)
+        return arr
+
     def to_sponge_nbt(self, mc_version: int = MC_DATA_VERSION, gzipped: bool = True,
-                      endianness: str = 'big') -> nbtlib.nbt.File:
+                      endianness: str = 'big', compression: Optional[Compression] = None,
+                      compression_level: Optional[int] = None, version: int = SPONGE_VERSION) -> nbtlib.nbt.File:
         """
-        Returns the Region as an NBT Compound file that conforms to the Sponge Schematic Format (version 2) used by mods
-        like WorldEdit.
+        Returns the Region as an NBT Compound file that conforms to the Sponge Schematic Format (version 2 or 3)
+        used by mods like WorldEdit.
         Check `the file format specification <https://github.com/SpongePowered/Schematic-Specification>`_
         for more information.
+        Biomes are only written to version 3 files, for regions that were read from one.
 
         :param mc_version:  Minecraft data version that is being emulated
                             (https://minecraft.wiki/w/Data_version).
@@ -396,15 +743,22 @@ class Region:
                             (WorldEdit only works with gzipped files).
         :param endianness:  Endianness of the resulting NBT Compound file
                             ('big' or 'little', WorldEdit only works with big endian files).
+        :param compression: The codec used to compress the file when it is saved, overrides gzipped when set
+                            (see :func:`litemapy.nbtio.compress_stream`).
+        :param compression_level:   The compression level of the gzip and zlib codecs, from 0 to 9.
+        :param version:     The version of the Sponge Schematic Format to use, either 2 or 3
+                            (WorldEdit writes version 3 since Minecraft 1.20.2).
 
         :returns:           The Region represented as a Sponge Schematic NBT Compound file.
+
+        :raises ValueError: if the version is not supported
         """
+        if version not in SPONGE_SUPPORTED_VERSIONS:
+            raise ValueError("Unsupported Sponge schematic version {}".format(version))
 
         self._optimize_palette()
 
-        # TODO Needs unit tests
-
-        nbt = nbtlib.File(gzipped=gzipped, byteorder=endianness)
+        nbt = _compressed_file(gzipped, endianness, compression, compression_level)
 
         nbt['DataVersion'] = Int(mc_version)
         nbt['Version'] = Int(SPONGE_VERSION)
@@ -447,6 +801,9 @@ class Region:
             tile_entity_tag['Pos'] = IntArray([Int(coord) for coord in tile_entity.position])
             for key in ['x', 'y', 'z']:
                 del tile_entity_tag[key]
+            if 'id' in tile_entity_tag:
+                tile_entity_tag['Id'] = tile_entity_tag['id']
+                del tile_entity_tag['id']
             tile_entities.append(tile_entity_tag)
 
         nbt['BlockEntities'] = tile_entities
@@ -460,43 +817,77 @@ class Region:
 
         nbt['Palette'] = palette
 
-        # process blocks
-        block_array = []
-        for i in range(abs(self.__width * self.__height * self.__length)):
-            blocks_per_layer = abs(self.__width * self.__length)
-            y = int(i / blocks_per_layer)
-            i_in_layer = i % blocks_per_layer
-            z = int(i_in_layer / abs(self.__width))
-            x = i_in_layer % abs(self.__width)
-            block_array.append(self.__blocks[x, y, z])
+        nbt['BlockData'] = _encode_sponge_data(self.__blocks)
 
-        nbt['BlockData'] = ByteArray([Byte(id) for id in block_array])
+        if version == 3:
+            schematic = _sponge_v2_to_v3(nbt)
+            if self.__biomes is not None:
+                biomes, biome_palette = self.__biomes
+                schematic['Biomes'] = Compound({
+                    'Palette': Compound({name: Int(i) for i, name in enumerate(biome_palette)}),
+                    'Data': _encode_sponge_data(biomes),
+                })
+            nbt.clear()
+            nbt['Schematic'] = schematic
 
         return nbt
 
     @staticmethod
     def from_sponge_nbt(nbt: Compound) -> tuple['Region', int]:
         """
-        Returns a Litematica Region based on an NBT Compound that conforms to the Sponge Schematic Format (version 2)
-        used by mods like WorldEdit.
+        Returns a Litematica Region based on an NBT Compound that conforms to the Sponge Schematic Format
+        (version 2 or 3) used by mods like WorldEdit.
         Check `the file format specification <https://github.com/SpongePowered/Schematic-Specification>`_
         for more information.
+        Biomes of version 3 schematics are kept, so they can be written back by :func:`~litemapy.Region.to_sponge_nbt`.
 
         :param nbt: The Sponge schematic NBT Compound.
 
         :returns:   a Litematica Region built from the Sponge schematic
                     and the Minecraft data version that the Sponge schematic was created for.
-        """
 
-        # TODO Needs unit tests
+        :raises CorruptedSchematicError: if the block or biome data is malformed
+        """
+        biome_tag = None
+        if 'Schematic' in nbt:
+            biome_tag = nbt['Schematic'].get('Biomes')
+            nbt = _sponge_v3_to_v2(nbt['Schematic'])
 
         mc_version = nbt['DataVersion']
         width = int(nbt['Width'])
         height = int(nbt['Height'])
         length = int(nbt['Length'])
-        region = Region(0, 0, 0, width, height, length)
         offset = nbt['Offset']
 
+        # process blocks, mapping Sponge palette ids to our own palette in which air comes first
+        sponge_palette = {int(index): _parse_block_state_identifier(str(block))
+                          for block, index in nbt['Palette'].items()}
+        palette = [AIR]
+        palette_index = {AIR: 0}
+        lut = np.zeros(max(sponge_palette.keys(), default=-1) + 1, dtype=np.int64)
+        known = np.zeros(len(lut), dtype=np.bool_)
+        for sponge_index, block_state in sorted(sponge_palette.items()):
+            if block_state not in palette_index:
+                palette_index[block_state] = len(palette)
+                palette.append(block_state)
+            lut[sponge_index] = palette_index[block_state]
+            known[sponge_index] = True
+        indices = _decode_sponge_data(nbt['BlockData'], (width, height, length))
+        if indices.size > 0 and (indices.max() >= len(lut) or not known[indices].all()):
+            raise CorruptedSchematicError("Sponge block data references blocks that are not in the palette")
+        region = Region.from_array(lut.astype(_block_dtype(len(palette)))[indices], palette)
+
+        if biome_tag is not None:
+            biome_palette = {int(index): str(name) for name, index in biome_tag['Palette'].items()}
+            biome_lut = np.full(max(biome_palette.keys(), default=-1) + 1, -1, dtype=np.int64)
+            for i, sponge_index in enumerate(sorted(biome_palette)):
+                biome_lut[sponge_index] = i
+            biomes = _decode_sponge_data(biome_tag['Data'], (width, height, length))
+            if biomes.size > 0 and (biomes.max() >= len(biome_lut) or (biome_lut[biomes] < 0).any()):
+                raise CorruptedSchematicError("Sponge biome data references biomes that are not in the palette")
+            region.__biomes = (biome_lut.astype(np.uint32)[biomes],
+                               tuple(biome_palette[i] for i in sorted(biome_palette)))
+
         # process entities
         for entity in nbt['Entities']:
             if 'Id' not in entity.keys():
@@ -522,35 +913,22 @@ class Region:
             del tile_entity['Pos']
             region.tile_entities.append(tent)
 
-        # process blocks and let __setitem__() automatically generate the palette
-        palette = nbt['Palette']
-        palette_dict = {}
-        for block, index in palette.items():
-            property_dict = {}
-            if block.find('[') == -1:
-                block_id = block
-            else:
-                entries = block.split('[')
-                block_id = entries[0]
-                properties = entries[1].replace(']', '').split(',')
-                for property in properties:
-                    key, value = property.split('=')
-                    property_dict[key] = value
-
-            block_state = BlockState(block_id, **property_dict)
-            palette_dict[int(index)] = block_state
-
-        for i, index in enumerate(nbt['BlockData']):
-            blocks_per_layer = width * length
-            y = int(i / blocks_per_layer)
-            i_in_layer = i % blocks_per_layer
-            z = int(i_in_layer / width)
-            x = i_in_layer % width
-            region[x, y, z] = palette_dict[int(index)]
-
         return region, mc_version
 
-    def to_structure_nbt(self, mc_version=MC_DATA_VERSION, gzipped=True, byteorder='big') -> nbtlib.nbt.File:
+    async def ato_sponge_nbt(self, executor: Optional[Executor] = None, **kwargs) -> nbtlib.nbt.File:
+        """
+        Exports the region to the Sponge Schematic Format without blocking the event loop,
+        the region should not be modified until this completes.
+        Other arguments are the same as for :func:`~litemapy.Region.to_sponge_nbt`.
+
+        :param executor:    the executor to run the work in,
+                            defaults to a thread pool shared by asynchronous methods which bounds their concurrency
+        """
+        return await _run_in_executor(executor, self.to_sponge_nbt, **kwargs)
+
+    def to_structure_nbt(self, mc_version=MC_DATA_VERSION, gzipped=True, byteorder='big',
+                         compression: Optional[Compression] = None,
+                         compression_level: Optional[int] = None) -> nbtlib.nbt.File:
         """
         Returns the Region as an NBT Compound file that conforms to Minecraft's structure NBT files.
 
@@ -561,6 +939,9 @@ class Region:
                             (Vanilla Minecraft only works with gzipped files).
         :param byteorder:   Endianness of the resulting NBT Compound file
                             ('big' or 'little', Vanilla Minecraft only works with big endian files).
+        :param compression: The codec used to compress the file when it is saved, overrides gzipped when set
+                            (see :func:`litemapy.nbtio.compress_stream`).
+        :param compression_level:   The compression level of the gzip and zlib codecs, from 0 to 9.
 
         :returns:           The Region represented as a Minecraft structure NBT file.
         """
@@ -569,7 +950,7 @@ class Region:
 
         self._optimize_palette()
 
-        structure = nbtlib.File(gzipped=gzipped, byteorder=byteorder)
+        structure = _compressed_file(gzipped, byteorder, compression, compression_level)
 
         structure['size'] = List[Int]([abs(self.__width), abs(self.__height), abs(self.__length)])
         structure['DataVersion'] = Int(mc_version)
@@ -616,6 +997,17 @@ class Region:
 
         return structure
 
+    async def ato_structure_nbt(self, executor: Optional[Executor] = None, **kwargs) -> nbtlib.nbt.File:
+        """
+        Exports the region to Minecraft's structure format without blocking the event loop,
+        the region should not be modified until this completes.
+        Other arguments are the same as for :func:`~litemapy.Region.to_structure_nbt`.
+
+        :param executor:    the executor to run the work in,
+                            defaults to a thread pool shared by asynchronous methods which bounds their concurrency
+        """
+        return await _run_in_executor(executor, self.to_structure_nbt, **kwargs)
+
     @staticmethod
     def from_structure_nbt(structure: Compound) -> tuple['Region', str]:
         """
@@ -665,19 +1057,92 @@ class Region:
 
     def __setitem__(self, position: tuple[int, int, int], block: BlockState) -> None:
         x, y, z = self.__region_coordinates_to_store_coordinates(*position)
-        if block in self.__palette:
-            i = self.__palette.index(block)
-        else:
-            self.__palette.append(block)
-            i = len(self.__palette) - 1
+        i = self.__intern(block)
+        old = self.__blocks[x, y, z]
+        if old != i and old != 0:
+            # The previous entry may no longer be used anywhere
+            self.__palette_dirty = True
         self.__blocks[x, y, z] = i
 
     @deprecated("Region.setblock() is deprecated. Use array style syntax instead: region[x, y, z]")
     def setblock(self, x: int, y: int, z: int, block: BlockState):
         return self.__setitem__((x, y, z), block)
 
+    def fill(self, first: tuple[int, int, int], second: tuple[int, int, int], block: BlockState,
+             mask: Optional[np.ndarray] = None) -> None:
+        """
+        Sets every position in a box to the same :class:`BlockState`.
+        The palette is only looked up once and the box is written in bulk,
+        which is a lot faster than setting positions one at a time.
+
+        :param first:   a corner of the box, in the region's coordinate system
+        :param second:  the opposite corner of the box, in the region's coordinate system (inclusive)
+        :param block:   the block state to fill the box with
+        :param mask:    an optional boolean array with the same shape as the box,
+                        indexed along increasing X, Y and Z coordinates.
+                        When provided, only positions where the mask is True are set.
+
+        :raises IndexError: if the box is not entirely within the region
+        :raises ValueError: if the mask does not have the same shape as the box
+        """
+        box = self.__region_box_to_store_slices(first, second)
+        if mask is not None:
+            mask = np.asarray(mask, dtype=np.bool_)
+            shape = tuple(axis.stop - axis.start for axis in box)
+            if mask.shape != shape:
+                raise ValueError("Mask shape {} does not match box shape {}".format(mask.shape, shape))
+        index = self.__intern(block)
+        if mask is None:
+            self.__blocks[box] = index
+        else:
+            self.__blocks[box] = np.where(mask, index, self.__blocks[box])
+        # Filling may overwrite every occurrence of some palette entries
+        self.__palette_dirty = True
+
+    def set_blocks(self, positions: np.ndarray,
+                   blocks: Union[BlockState, Sequence[BlockState], np.ndarray]) -> None:
+        """
+        Sets many positions at once.
+        Coordinates are translated and written in bulk,
+        which is a lot faster than setting positions one at a time.
+        When a position is repeated, the last matching block is kept.
+
+        :param positions:   an integer array of shape (N, 3) with the X, Y and Z coordinates of each position,
+                            in the region's coordinate system
+        :param blocks:      either a single :class:`BlockState` to set at every position,
+                            a sequence of N :class:`BlockState`,
+                            or an integer array of N indices into this region's :attr:`palette`
+
+        :raises IndexError: if a position is not within the region or a palette index is out of range
+        :raises ValueError: if positions and blocks do not have matching shapes
+        """
+        positions = np.array(positions, dtype=np.int64)  # Copied, coordinates get translated in place
+        if positions.ndim != 2 or positions.shape[1] != 3:
+            raise ValueError("Positions should have shape (N, 3), not {}".format(positions.shape))
+        x, y, z = self.__region_coordinates_to_store_coordinates(positions[:, 0], positions[:, 1], positions[:, 2])
+        for coordinates, size in zip((x, y, z), self.__blocks.shape):
+            if len(coordinates) > 0 and (coordinates.min() < 0 or coordinates.max() >= size):
+                raise IndexError("Some positions are not within the region")
+
+        if isinstance(blocks, BlockState):
+            indices = self.__intern(blocks)
+        elif len(blocks) != len(positions) or isinstance(blocks, np.ndarray) and blocks.ndim != 1:
+            raise ValueError("Expected a sequence of {} blocks".format(len(positions)))
+        elif isinstance(blocks, np.ndarray) and blocks.dtype.kind in 'iu':
+            # Indices refer to the palette as it is exposed
+            self._optimize_palette()
+            indices = blocks
+            if len(indices) > 0 and (indices.min() < 0 or indices.max() >= len(self.__palette)):
+                raise IndexError("Palette indices out of range")
+        else:
+            indices = np.fromiter(map(self.__intern, blocks), dtype=np.int64, count=len(blocks))
+        self.__blocks[x, y, z] = indices
+        # Writing may overwrite every occurrence of some palette entries
+        self.__palette_dirty = True
+
     def __contains__(self, block: BlockState) -> bool:
-        return block in self.__palette and self.__palette.index(block) in self.__blocks
+        index = self.__palette_index.get(block)
+        return index is not None and index in self.__blocks
 
     @deprecated_name("getblockcount")
     def count_blocks(self) -> int:
@@ -688,7 +1153,45 @@ class Region:
         """
 
         # air is index zero
-        return np.count_nonzero(self.__blocks)
+        if isinstance(self.__blocks, SectionedBlockArray):
+            return self.__blocks.count_nonzero()
+        return sum(int(np.count_nonzero(self.__blocks[chunk])) for chunk in self.__block_chunks())
+
+    def __region_box_to_store_slices(self, first: tuple[int, int, int],
+                                     second: tuple[int, int, int]) -> tuple[slice, slice, slice]:
+        first = self.__region_coordinates_to_store_coordinates(*first)
+        second = self.__region_coordinates_to_store_coordinates(*second)
+        box = []
+        for start, end, size in zip(first, second, self.__blocks.shape):
+            start, end = min(start, end), max(start, end)
+            if start < 0 or end >= size:
+                raise IndexError("Box from {} to {} is not within the region".format(first, second))
+            box.append(slice(start, end + 1))
+        return box[0], box[1], box[2]
+
+    def __intern(self, block: BlockState) -> int:
+        # Returns the palette index of a block state, adding it to the palette if needed
+        index = self.__palette_index.get(block)
+        if index is None:
+            index = len(self.__palette)
+            self.__palette.append(block)
+            self.__palette_index[block] = index
+            self.__fit_dtype()
+        return index
+
+    def __fit_dtype(self) -> None:
+        # Promotes the block array to a larger integer type once the palette outgrows the current one
+        dtype = _block_dtype(len(self.__palette))
+        if np.iinfo(dtype).max <= np.iinfo(self.__blocks.dtype).max:
+            return
+        if self.__scratch_dir is None:
+            self.__blocks = self.__blocks.astype(dtype)
+            return
+        # Converting a memory-mapped array would load it entirely in memory
+        blocks = _scratch_array(self.__blocks.shape, dtype, self.__scratch_dir)
+        for chunk in self.__block_chunks():
+            blocks[chunk] = self.__blocks[chunk]
+        self.__blocks = blocks
 
     def __region_coordinates_to_store_coordinates(self, x: int, y: int, z: int) -> tuple[int, int, int]:
         if self.__width < 0:
@@ -709,15 +1212,20 @@ class Region:
         return abs(self.__width * self.__height * self.__length)
 
     def __get_needed_nbits(self) -> int:
-        return max(ceil(log(len(self.__palette), 2)), 2)
+        return _palette_nbits(len(self.__palette))
 
     @deprecated_name("fromnbt")
     @staticmethod
-    def from_nbt(nbt: Compound) -> 'Region':
+    def from_nbt(nbt: Compound, sparse: bool = False, scratch_dir: Optional[str] = None,
+                 lazy: bool = False) -> 'Region':
         """
         Read a region from an NBT tag.
 
-        :param nbt: an NBT tag to read the region from
+        :param nbt:         an NBT tag to read the region from
+        :param sparse:      whether the region should store its blocks in sections (see :class:`Region`)
+        :param scratch_dir: a directory to store the region's blocks in a memory-mapped file (see :class:`Region`)
+        :param lazy:        whether to only read the region's position and size right away,
+                            and keep the NBT tag to decode the rest of the region the first time it is needed
         """
         pos = nbt["Position"]
         x = int(pos["x"])
@@ -727,37 +1235,68 @@ class Region:
         width = int(size["x"])
         height = int(size["y"])
         length = int(size["z"])
-        region = Region(x, y, z, width, height, length)
-        del region.__palette[0]
-        for block_nbt in nbt["BlockStatePalette"]:
-            block = BlockState.from_nbt(block_nbt)
-            region.__palette.append(block)
-
-        for entity_nbt in nbt["Entities"]:
-            entity = Entity.from_nbt(entity_nbt)
-            region.entities.append(entity)
-
-        for tile_entity_nbt in nbt["TileEntities"]:
-            block = TileEntity.from_nbt(tile_entity_nbt)
-            region.tile_entities.append(block)
-
-        blocks = nbt["BlockStates"]
-        nbits = region.__get_needed_nbits()
-        bit_array = LitematicaBitArray.from_nbt_long_array(blocks, region.volume(), nbits)
-        for x in range(abs(width)):
-            for y in range(abs(height)):
-                for z in range(abs(length)):
-                    ind = (y * abs(width * length)) + z * abs(width) + x
-                    region.__blocks[x][y][z] = bit_array[ind]
-
-        for block_ticks in nbt["PendingBlockTicks"]:
-            region.__block_ticks.append(block_ticks)
-
-        for fluid_ticks in nbt["PendingFluidTicks"]:
-            region.__fluid_ticks.append(fluid_ticks)
+        if not lazy:
+            region = Region(x, y, z, width, height, length, sparse=sparse, scratch_dir=scratch_dir)
+            region.__decode_content(nbt)
+            return region
+        if width == 0 or height == 0 or length == 0:
+            raise ValueError("Region dimensions cannot be 0")
+        # Content attributes are left unset, so accessing them goes through __getattr__ which decodes them
+        region = Region.__new__(Region)
+        region.__x, region.__y, region.__z = x, y, z
+        region.__width, region.__height, region.__length = width, height, length
+        region.__sparse = sparse
+        region.__scratch_dir = scratch_dir
+        region.__pending_nbt = nbt
+        return region
 
+    @staticmethod
+    def _from_nbt_and_blocks(nbt: Compound, blocks: np.ndarray) -> 'Region':
+        # Reads a region whose block states were already decoded, by a worker process loading a schematic
+        region = Region.from_nbt(nbt, lazy=True)
+        region.__pending_nbt = None
+        region.__decode_content(nbt, blocks)
         return region
 
+    def _is_dense_in_memory(self) -> bool:
+        # Whether the blocks of this region are decoded and stored in a single in-memory array
+        return self.__dict__.get("_Region__pending_nbt") is None and not self.__sparse \
+            and self.__scratch_dir is None
+
+    def __decode_content(self, nbt: Compound, blocks: Optional[np.ndarray] = None) -> None:
+        self.__palette = [BlockState.from_nbt(block_nbt) for block_nbt in nbt["BlockStatePalette"]]
+        self.__rebuild_palette_index()
+        self.__palette_dirty = True  # There is no guarantee the palette we read is optimized
+
+        self.__entities = [Entity.from_nbt(entity_nbt) for entity_nbt in nbt["Entities"]]
+        self.__tile_entities = [TileEntity.from_nbt(tile_entity_nbt) for tile_entity_nbt in nbt["TileEntities"]]
+
+        if blocks is None:
+            nbits = self.__get_needed_nbits()
+            arr = LitematicaBitArray.from_nbt_long_array(nbt["BlockStates"], self.volume(), nbits)
+            blocks = self.__allocate_blocks()
+            _unpack_region_blocks(arr, blocks)
+        self.__blocks = blocks
+
+        self.__block_ticks = list(nbt["PendingBlockTicks"])
+        self.__fluid_ticks = list(nbt["PendingFluidTicks"])
+
+    def __getattr__(self, name: str) -> Any:
+        # Only called for missing attributes, which is the case for the content of lazy regions until it is decoded
+        pending = self.__dict__.get("_Region__pending_nbt")
+        if pending is None or name not in _LAZY_REGION_ATTRIBUTES:
+            raise AttributeError("'Region' object has no attribute '{}'".format(name))
+        self.__pending_nbt = None
+        try:
+            self.__decode_content(pending)
+        except BaseException:
+            # Leave the region as it was, so the next access retries decoding and fails the same way
+            for attribute in _LAZY_REGION_ATTRIBUTES:
+                self.__dict__.pop(attribute, None)
+            self.__pending_nbt = pending
+            raise
+        return getattr(self, name)
+
     @deprecated_name("minschemx")
     def min_schem_x(self) -> int:
         """
@@ -956,6 +1495,66 @@ class Region:
         self._optimize_palette()
         return tuple(self.__palette)
 
+    def to_array(self) -> tuple[np.ndarray, tuple[BlockState, ...]]:
+        """
+        Exposes the content of this region as an array of indices into its palette.
+        The array is a read-only view of the region's storage and is not copied,
+        it will reflect later changes to the region until its palette outgrows the array's integer type.
+        The region then moves its blocks to a new array with a larger type, and the view stops being updated,
+        so :func:`to_array` should be called again after adding blocks to the palette.
+        Sparse regions do not store their blocks in a single array,
+        so a read-only copy is returned for them instead.
+        Item [i, j, k] of the array is the palette index of the block at coordinates
+        (min_x() + i, min_y() + j, min_z() + k) in the region's coordinate system.
+
+        :returns: the array of palette indices and the palette
+        """
+        self._optimize_palette()
+        if isinstance(self.__blocks, SectionedBlockArray):
+            view = np.asarray(self.__blocks)
+        else:
+            view = self.__blocks.view()
+        view.flags.writeable = False
+        return view, tuple(self.__palette)
+
+    @staticmethod
+    def from_array(blocks: np.ndarray, palette: Sequence[BlockState], x: int = 0, y: int = 0, z: int = 0) -> 'Region':
+        """
+        Creates a region from an array of indices into a palette.
+        The region has the shape of the array, and item [i, j, k] of the array
+        is the palette index of the block at coordinates (i, j, k) in the region's coordinate system.
+        The array is used as the region's storage without being copied
+        if it is a C contiguous array of unsigned 8, 16 or 32 bits integers large enough for the palette,
+        in which case later changes to the region will be reflected in the array
+        until the palette outgrows the array's integer type.
+        The region then moves its blocks to a new array with a larger type, and stops sharing the given one.
+
+        :param blocks:  a three-dimensional integer array of palette indices
+        :param palette: the block states the indices refer to, the first one must be air
+        :param x:       the X coordinate of the region in the schematic
+        :param y:       the Y coordinate of the region in the schematic
+        :param z:       the Z coordinate of the region in the schematic
+
+        :raises ValueError: if the array is not a valid three-dimensional array of palette indices,
+                            or the palette does not start with air
+        """
+        blocks = np.asarray(blocks)
+        if blocks.ndim != 3 or blocks.dtype.kind not in 'iu':
+            raise ValueError("Blocks should be a three-dimensional integer array")
+        if len(palette) < 1 or palette[0] != AIR:
+            raise ValueError("The first palette entry should be air")
+        if blocks.size > 0 and (blocks.min() < 0 or blocks.max() >= len(palette)):
+            raise ValueError("Blocks contain indices that are not in the palette")
+        region = Region(x, y, z, *blocks.shape)
+        if blocks.dtype not in (np.uint8, np.uint16, np.uint32):
+            blocks = blocks.astype(_block_dtype(len(palette)))
+        region.__blocks = np.ascontiguousarray(blocks)
+        region.__palette = list(palette)
+        region.__rebuild_palette_index()
+        region.__fit_dtype()
+        region.__palette_dirty = True
+        return region
+
     def as_schematic(self, name: str = DEFAULT_NAME, author: str = "", description: str = "",
                      mc_version: int = MC_DATA_VERSION) -> Schematic:
         """
@@ -971,30 +1570,79 @@ class Region:
     def __replace_palette_index(self, old_index: int, new_index: int) -> None:
         if old_index == new_index:
             return
-        self.__blocks[self.__blocks == old_index] = new_index
+        lut = np.arange(len(self.__palette), dtype=self.__blocks.dtype)
+        lut[old_index] = new_index
+        self.__remap_blocks(lut)
 
     def _optimize_palette(self) -> None:
         # Functions that work directly with the palette like filter or replace
         # may introduce duplicates or unused entries in the palette.
         # For this reason, it is necessary to clean things up before exporting
-        # block content in any way
+        # block content in any way.
+        # Those functions mark the palette as dirty, so a clean palette is not scanned again.
+        if not self.__palette_dirty:
+            return
+        usage = self.__count_palette_usage()
+        lut = np.zeros(len(self.__palette), dtype=self.__blocks.dtype)
         new_palette = []
+        new_palette_index = {}
         for old_index, state in enumerate(self.__palette):
             # Skip unused entries, except air that needs to remain at index 0
-            if old_index != 0 and old_index not in self.__blocks:
+            if old_index != 0 and usage[old_index] == 0:
                 continue
             # Do not copy duplicate entries multiple times
-            for i, other_state in enumerate(new_palette):
-                if state == other_state:
-                    new_index = i
-                    break
-            else:
+            new_index = new_palette_index.get(state)
+            if new_index is None:
                 # Keep that entry
                 new_index = len(new_palette)
                 new_palette.append(state)
-            # Update blocks to reflect the new palette
-            self.__replace_palette_index(old_index, new_index)
+                new_palette_index[state] = new_index
+            lut[old_index] = new_index
+        # Update blocks to reflect the new palette
+        if not np.array_equal(lut, np.arange(len(lut))):
+            self.__remap_blocks(lut)
         self.__palette = new_palette
+        self.__palette_index = new_palette_index
+        self.__palette_dirty = False
+
+    def __block_chunks(self) -> Generator[slice, None, None]:
+        # Splits the block array along the X axis, so bulk operations on large regions
+        # work on bounded temporary arrays instead of converting the whole array at once
+        width, height, length = self.__blocks.shape
+        step = max(1, _BLOCK_CHUNK_SIZE // max(1, height * length))
+        for start in range(0, width, step):
+            yield slice(start, start + step)
+
+    def __allocate_blocks(self) -> Union[np.ndarray, SectionedBlockArray]:
+        shape = (abs(self.__width), abs(self.__height), abs(self.__length))
+        dtype = _block_dtype(len(self.__palette))
+        if self.__sparse:
+            return SectionedBlockArray(shape, dtype)
+        if self.__scratch_dir is not None:
+            return _scratch_array(shape, dtype, self.__scratch_dir)
+        return np.zeros(shape, dtype=dtype)
+
+    def __count_palette_usage(self) -> np.ndarray:
+        if isinstance(self.__blocks, SectionedBlockArray):
+            return self.__blocks.bincount(len(self.__palette))[:len(self.__palette)]
+        usage = np.zeros(len(self.__palette), dtype=np.int64)
+        for chunk in self.__block_chunks():
+            usage += np.bincount(self.__blocks[chunk].ravel(), minlength=len(usage))[:len(usage)]
+        return usage
+
+    def __remap_blocks(self, lut: np.ndarray) -> None:
+        if isinstance(self.__blocks, SectionedBlockArray):
+            self.__blocks.remap(lut)
+            return
+        for chunk in self.__block_chunks():
+            self.__blocks[chunk] = lut[self.__blocks[chunk]]
+
+    def __rebuild_palette_index(self) -> None:
+        # Maps each block state to its first occurrence in the palette,
+        # the palette may temporarily contain duplicates until it gets optimized
+        self.__palette_index = {}
+        for index, state in enumerate(self.__palette):
+            self.__palette_index.setdefault(state, index)
 
     def filter(self, function: Callable[[BlockState], BlockState]) -> None:
         """
@@ -1010,8 +1658,11 @@ class Region:
         # We need to ensure we always have air at palette index 0
         if self.__palette[0] != AIR:
             self.__palette.append(self.__palette[0])
+            self.__fit_dtype()
             self.__replace_palette_index(0, len(self.__palette) - 1)
             self.__palette[0] = AIR
+        self.__rebuild_palette_index()
+        self.__palette_dirty = True
 
     def replace(self, replace: BlockState, replace_with: BlockState) -> None:
         """
@@ -1022,20 +1673,325 @@ class Region:
         :param replace:         the blockstate to replace
         :param replace_with:    a new blockstate to replace the old one with
         """
-        try:
-            index = self.__palette.index(replace)
-        except ValueError:
+        index = self.__palette_index.get(replace)
+        if index is None:
             return  # Nothing to do
         if index == 0:
             # We are replacing air, that's not good
             self.__palette.append(replace_with)
+            self.__fit_dtype()
             self.__replace_palette_index(0, len(self.__palette) - 1)
         else:
             self.__palette[index] = replace_with
+        self.__rebuild_palette_index()
+        self.__palette_dirty = True
 
 
 AIR = BlockState("minecraft:air")
 
+# Region attributes that lazy regions decode from their NBT tag the first time they are accessed
+_LAZY_REGION_ATTRIBUTES = frozenset("_Region__" + name for name in (
+    "palette", "palette_index", "palette_dirty", "blocks",
+    "entities", "tile_entities", "block_ticks", "fluid_ticks",
+))
+
+
+def _region_selector(regions: Optional[RegionSelection], names: Iterable[str]) -> Callable[[str], bool]:
+    if regions is None:
+        return lambda name: True
+    if callable(regions):
+        return regions
+    wanted = set(regions)
+    missing = wanted.difference(str(name) for name in names)
+    if missing:
+        raise KeyError("Regions not found in schematic: {}".format(", ".join(sorted(missing))))
+    return wanted.__contains__
+
+
+# Maximum number of loads and saves the shared executor of asynchronous methods runs at once
+ASYNC_MAX_WORKERS = min(4, cpu_count() or 1)
+_async_executor: Optional[ThreadPoolExecutor] = None
+_async_executor_lock = Lock()
+
+
+def _shared_async_executor() -> ThreadPoolExecutor:
+    global _async_executor
+    with _async_executor_lock:
+        if _async_executor is None:
+            _async_executor = ThreadPoolExecutor(max_workers=ASYNC_MAX_WORKERS, thread_name_prefix="litemapy")
+        return _async_executor
+
+
+async def _run_in_executor(executor: Optional[Executor], function: Callable, *args, **kwargs) -> Any:
+    # Decompression, compression and the bulk NumPy operations release the GIL,
+    # so running them in threads keeps the event loop responsive
+    if executor is None:
+        executor = _shared_async_executor()
+    return await asyncio.get_running_loop().run_in_executor(executor, partial(function, *args, **kwargs))
+
+
+def _compressed_file(gzipped: bool, byteorder: str, compression: Optional[Compression],
+                     compression_level: Optional[int]) -> CompressedFile:
+    compression = compression_from_gzipped(compression, gzipped)
+    check_compression(compression, compression_level)
+    return CompressedFile(compression=compression, compression_level=compression_level, byteorder=byteorder)
+
+
+def _encode_sponge_data(values: Union[np.ndarray, SectionedBlockArray]) -> ByteArray:
+    # Sponge stores palette indices as varints in YZX order, whereas we index them in XYZ order
+    data = [
+        encode_varints(np.asarray(values[:, layers, :]).transpose(1, 2, 0).ravel())
+        for layers in _layer_bands(values.shape)
+    ]
+    return ByteArray(np.concatenate(data).view(np.int8) if len(data) > 1 else data[0].view(np.int8))
+
+
+def _decode_sponge_data(data: ByteArray, shape: tuple[int, int, int]) -> np.ndarray:
+    width, height, length = shape
+    try:
+        values = decode_varints(data, width * height * length)
+    except ValueError as e:
+        raise CorruptedSchematicError("Invalid Sponge palette data: {}".format(e)) from e
+    return np.ascontiguousarray(values.reshape(height, length, width).transpose(2, 0, 1))
+
+
+def _sponge_v2_to_v3(nbt: Compound) -> Compound:
+    # Version 3 nests blocks in a container, and moves (block) entity data to a Data compound
+    schematic = Compound()
+    schematic['Version'] = Int(3)
+    for key in ('DataVersion', 'Width', 'Height', 'Length', 'Offset'):
+        schematic[key] = nbt[key]
+    block_entities = List[Compound]()
+    for tile_entity in nbt['BlockEntities']:
+        block_entities.append(_sponge_v3_entity(tile_entity))
+    schematic['Blocks'] = Compound({
+        'Palette': nbt['Palette'],
+        'Data': nbt['BlockData'],
+        'BlockEntities': block_entities,
+    })
+    schematic['Entities'] = List[Compound]([_sponge_v3_entity(entity) for entity in nbt['Entities']])
+    return schematic
+
+
+def _sponge_v3_entity(tag: Compound) -> Compound:
+    data = Compound({key: value for key, value in tag.items() if key not in ('Id', 'Pos')})
+    return Compound({'Id': tag['Id'], 'Pos': tag['Pos'], 'Data': data})
+
+
+def _sponge_v3_to_v2(schematic: Compound) -> Compound:
+    # Flattens a version 3 schematic into the layout of version 2, without its biomes
+    nbt = Compound()
+    nbt['Version'] = Int(2)
+    nbt['DataVersion'] = schematic['DataVersion']
+    for key in ('Width', 'Height', 'Length'):
+        nbt[key] = schematic[key]
+    nbt['Offset'] = schematic.get('Offset', IntArray([0, 0, 0]))
+    blocks = schematic.get('Blocks')
+    if blocks is None:
+        # Schematics without blocks are filled with air
+        volume = int(schematic['Width']) * int(schematic['Height']) * int(schematic['Length'])
+        blocks = Compound({'Palette': Compound({'minecraft:air': Int(0)}), 'Data': ByteArray(np.zeros(volume))})
+    nbt['Palette'] = blocks['Palette']
+    nbt['BlockData'] = blocks['Data']
+    nbt['BlockEntities'] = List[Compound]([_sponge_v2_entity(tag) for tag in blocks.get('BlockEntities', [])])
+    nbt['Entities'] = List[Compound]([_sponge_v2_entity(tag) for tag in schematic.get('Entities', [])])
+    return nbt
+
+
+def _sponge_v2_entity(tag: Compound) -> Compound:
+    entity = Compound(tag.get('Data', Compound()))
+    if 'Id' in tag:
+        entity['Id'] = tag['Id']
+    if 'Pos' in tag:
+        entity['Pos'] = tag['Pos']
+    return entity
+
+
+def _parse_block_state_identifier(identifier: str) -> BlockState:
+    # Parses identifiers such as "minecraft:oak_log[axis=y]", as found in Sponge palettes
+    if identifier.find('[') == -1:
+        return BlockState(identifier)
+    block_id, properties = identifier.split('[', 1)
+    property_dict = {}
+    for entry in properties.replace(']', '').split(','):
+        key, value = entry.split('=')
+        property_dict[key] = value
+    return BlockState(block_id, **property_dict)
+
+
+def _block_dtype(palette_size: int) -> type:
+    # The smallest unsigned integer type that can index every entry of a palette
+    for dtype in (np.uint8, np.uint16):
+        if palette_size - 1 <= np.iinfo(dtype).max:
+            return dtype
+    return np.uint32
+
+
+def _palette_nbits(palette_size: int) -> int:
+    # The number of bits Litematica uses to store each block of a region with a palette of that size
+    if palette_size < 1:
+        raise ValueError("Block state palettes cannot be empty")
+    return max((palette_size - 1).bit_length(), 2)
+
+
+def _scratch_array(shape: tuple[int, int, int], dtype: type, directory: str) -> np.memmap:
+    # The scratch file is unlinked as soon as it is closed,
+    # but the memory mapping keeps its content alive until the array is garbage collected
+    with TemporaryFile(dir=directory) as file:
+        return np.memmap(file, dtype=dtype, mode='w+', shape=shape)
+
+
+# Maximum number of blocks processed at once by bulk operations on region block arrays
+_BLOCK_CHUNK_SIZE = 1 << 22
+
+
+def _layer_bands(shape: tuple[int, int, int]) -> Generator[slice, None, None]:
+    # Splits a block array along the Y axis, in bands aligned with sections
+    width, height, length = shape
+    step = max(16, _BLOCK_CHUNK_SIZE // max(1, width * length) // 16 * 16)
+    for start in range(0, height, step):
+        yield slice(start, min(start + step, height))
+
+
+def _unpack_region_blocks(arr: LitematicaBitArray, blocks: Union[np.ndarray, SectionedBlockArray]) -> None:
+    width, height, length = blocks.shape
+    layer_size = width * length
+    for layers in _layer_bands(blocks.shape):
+        band = arr[layers.start * layer_size:layers.stop * layer_size]
+        # Litematica stores blocks in YZX order, whereas we index them in XYZ order
+        blocks[:, layers, :] = band.reshape(-1, length, width).transpose(2, 0, 1)
+
+
+def _pack_region_blocks(blocks: Union[np.ndarray, SectionedBlockArray], arr: LitematicaBitArray) -> None:
+    width, height, length = blocks.shape
+    layer_size = width * length
+    for layers in _layer_bands(blocks.shape):
+        # Litematica stores blocks in YZX order, whereas we index them in XYZ order
+        band = np.asarray(blocks[:, layers, :]).transpose(1, 2, 0).ravel()
+        arr[layers.start * layer_size:layers.start * layer_size + len(band)] = band
+
+
+def _decode_blocks_in_worker(words_name: str, out_name: str, shape: tuple[int, int, int], dtype: str,
+                             nbits: int) -> None:
+    # Runs in a worker process, decodes the block states of a region from a shared memory block to another
+    words_memory = SharedMemory(words_name)
+    out_memory = SharedMemory(out_name)
+    try:
+        size = shape[0] * shape[1] * shape[2]
+        arr = LitematicaBitArray(0, nbits)
+        arr.size = size
+        arr.array = np.ndarray(ceil(size * nbits / 64), dtype='>u8', buffer=words_memory.buf)
+        blocks = np.ndarray(shape, dtype=dtype, buffer=out_memory.buf)
+        _unpack_region_blocks(arr, blocks)
+        del arr, blocks
+    finally:
+        words_memory.close()
+        out_memory.close()
+
+
+def _encode_blocks_in_worker(blocks_name: str, out_name: str, shape: tuple[int, int, int], dtype: str,
+                             nbits: int) -> None:
+    # Runs in a worker process, encodes the block states of a region from a shared memory block to another
+    blocks_memory = SharedMemory(blocks_name)
+    out_memory = SharedMemory(out_name)
+    try:
+        size = shape[0] * shape[1] * shape[2]
+        blocks = np.ndarray(shape, dtype=dtype, buffer=blocks_memory.buf)
+        arr = LitematicaBitArray(0, nbits)
+        arr.size = size
+        arr.array = np.ndarray(ceil(size * nbits / 64), dtype=np.uint64, buffer=out_memory.buf)
+        arr.array[:] = 0
+        _pack_region_blocks(blocks, arr)
+        del arr, blocks
+    finally:
+        blocks_memory.close()
+        out_memory.close()
+
+
+def _shared_array(shape: Union[int, tuple[int, ...]], dtype: Any) -> tuple[SharedMemory, np.ndarray]:
+    # Shared memory blocks cannot be empty
+    size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    memory = SharedMemory(create=True, size=max(1, size))
+    return memory, np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+
+
+def _release_shared_memory(memory: SharedMemory) -> None:
+    memory.close()
+    memory.unlink()
+
+
+def _decode_regions_in_parallel(tags: dict[str, Compound], workers: int) -> dict[str, 'Region']:
+    # Decodes the block states of regions in a pool of worker processes,
+    # moving the packed and unpacked blocks through shared memory instead of pickling them
+    jobs = []
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for name, nbt in tags.items():
+                size = nbt["Size"]
+                shape = (abs(int(size["x"])), abs(int(size["y"])), abs(int(size["z"])))
+                palette_size = len(nbt["BlockStatePalette"])
+                longs = np.asarray(nbt["BlockStates"])
+                nbits = _palette_nbits(palette_size) if palette_size > 0 else 0
+                if nbits == 0 or len(longs) != ceil(shape[0] * shape[1] * shape[2] * nbits / 64):
+                    # Let the regular code path raise the appropriate error
+                    jobs.append((name, None, None, None, None))
+                    continue
+                words_memory, words = _shared_array(len(longs), '>i8')
+                words[:] = longs
+                del words
+                dtype = np.dtype(_block_dtype(palette_size))
+                out_memory, blocks = _shared_array(shape, dtype)
+                del blocks
+                future = executor.submit(_decode_blocks_in_worker, words_memory.name, out_memory.name,
+                                         shape, dtype.str, nbits)
+                jobs.append((name, future, words_memory, out_memory, (shape, dtype)))
+            regions: dict[str, 'Region'] = {}
+            for name, future, words_memory, out_memory, layout in jobs:
+                if future is None:
+                    regions[name] = Region.from_nbt(tags[name])
+                    continue
+                future.result()
+                shape, dtype = layout
+                blocks = np.array(np.ndarray(shape, dtype=dtype, buffer=out_memory.buf))
+                regions[name] = Region._from_nbt_and_blocks(tags[name], blocks)
+            return regions
+    finally:
+        for _, _, words_memory, out_memory, _ in jobs:
+            if words_memory is not None:
+                _release_shared_memory(words_memory)
+                _release_shared_memory(out_memory)
+
+
+def _encode_regions_in_parallel(regions: dict[str, 'Region'], workers: int) -> dict[str, LongArray]:
+    # Encodes the block states of regions in a pool of worker processes,
+    # moving the unpacked and packed blocks through shared memory instead of pickling them
+    jobs = []
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for name, region in regions.items():
+                blocks, palette = region.to_array()
+                nbits = _palette_nbits(len(palette))
+                blocks_memory, shared_blocks = _shared_array(blocks.shape, blocks.dtype)
+                shared_blocks[...] = blocks
+                del shared_blocks
+                word_count = ceil(blocks.size * nbits / 64)
+                out_memory, words = _shared_array(word_count, np.uint64)
+                del words
+                future = executor.submit(_encode_blocks_in_worker, blocks_memory.name, out_memory.name,
+                                         blocks.shape, blocks.dtype.str, nbits)
+                jobs.append((name, future, blocks_memory, out_memory, word_count))
+            block_states: dict[str, LongArray] = {}
+            for name, future, blocks_memory, out_memory, word_count in jobs:
+                future.result()
+                words = np.ndarray(word_count, dtype=np.int64, buffer=out_memory.buf)
+                block_states[name] = LongArray(words.astype('>i8'))
+                del words
+            return block_states
+    finally:
+        for _, _, blocks_memory, out_memory, _ in jobs:
+            _release_shared_memory(blocks_memory)
+            _release_shared_memory(out_memory)
+
 
 class CorruptedSchematicError(Exception):
     pass
@@ -1,24 +1,43 @@
+from itertools import product
 from math import ceil
 import nbtlib.tag
+import numpy as np
 from nbtlib import LongArray
-from typing import Generator, Callable, Any, Optional
+from typing import Generator, Callable, Any, Optional, Union
+
+# Maximum number of values handled at once by the vectorized bit array helpers,
+# this bounds the size of the temporary arrays they allocate.
+_BULK_CHUNK_SIZE = 1 << 20
 
 
 class LitematicaBitArray:
     size: int
     nbit: int
-    array: list[int]
+    array: np.ndarray[np.uint64, Any]
     __mask: int
+    __borrowed: bool  # Whether the array is the buffer of a long array, which should not be written to
 
     def __init__(self, size: int, nbits: int) -> None:
         self.size = size
         self.nbits = nbits
         s = ceil(nbits * size / 64)
-        self.array = [0] * s
+        self.array = np.zeros(s, dtype=np.uint64)
         self.__mask = (1 << nbits) - 1  # nbits bits set to 1
+        self.__borrowed = False
 
     @staticmethod
     def from_nbt_long_array(arr: LongArray, size: int, nbits: int) -> 'LitematicaBitArray':
+        """
+        Wraps an NBT long array into a bit array.
+        The buffer of the long array is shared and not copied until the bit array is first written to,
+        so writing to the bit array never modifies the long array.
+
+        :param arr:     the NBT long array the values are packed in
+        :param size:    the number of values in the bit array
+        :param nbits:   the number of bits used to store each value
+
+        :raises ValueError: if the length of the long array does not match size and nbits
+        """
         # TODO Test loading and validating from an external source
         expected_len = ceil(size * nbits / 64)
         if expected_len != len(arr):
@@ -27,25 +46,32 @@ class LitematicaBitArray:
                     expected_len, len(arr)
                 )
             )
-        r = LitematicaBitArray(size, nbits)
-        m = (1 << 64) - 1
-        r.array = [int(i) & m for i in arr]  # Remove the infinite trailing 1s of negative numbers
+        longs = np.asarray(arr)
+        if longs.dtype.kind != 'i' or longs.dtype.itemsize != 8:
+            longs = longs.astype(np.int64)
+        r = LitematicaBitArray(0, nbits)
+        r.size = size
+        # Reinterpret the signed longs as unsigned ones, keeping their byte order to avoid a copy
+        r.array = longs.view(np.dtype(np.uint64).newbyteorder(longs.dtype.byteorder))
+        r.__borrowed = True
         return r
 
     def _to_long_list(self) -> list[int]:
-        list_of_longs = []
-        m1 = 1 << 63
-        m2 = (1 << 64) - 1
-        for i in self.array:
-            if i & m1 > 0:
-                i |= ~m2  # Add the potential infinite 1 prefix for negative numbers
-            list_of_longs.append(i)
-        return list_of_longs
+        return self.array.astype(np.uint64).view(np.int64).tolist()
 
     def _to_nbt_long_array(self) -> LongArray:
-        return nbtlib.tag.LongArray(self._to_long_list())
+        # Keep the byte order of the buffer, so no copy is needed when it is already big endian
+        return nbtlib.tag.LongArray(self.array.view(np.dtype(np.int64).newbyteorder(self.array.dtype.byteorder)))
 
-    def __getitem__(self, index) -> int:
+    def __getitem__(self, index) -> Union[int, np.ndarray]:
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step == 1:
+                return _unpack_bits(self.array, self.nbits, start, max(start, stop))
+            return _gather_bits(self.array, self.nbits, np.arange(start, stop, step))
+        if not isinstance(index, (int, np.integer)):
+            return _gather_bits(self.array, self.nbits, self.__to_indices(index))
+        index = int(index)
         if not 0 <= index < len(self):
             raise IndexError("Invalid index {}".format(index))
         start_offset = index * self.nbits
@@ -54,13 +80,28 @@ class LitematicaBitArray:
         start_bit_offset = start_offset & 0x3F
 
         if start_arr_index == end_arr_index:
-            return self.array[start_arr_index] >> start_bit_offset & self.__mask
+            return int(self.array[start_arr_index]) >> start_bit_offset & self.__mask
         else:
             end_offset = 64 - start_bit_offset
-            val = self.array[start_arr_index] >> start_bit_offset | self.array[end_arr_index] << end_offset
+            val = int(self.array[start_arr_index]) >> start_bit_offset | int(self.array[end_arr_index]) << end_offset
             return val & self.__mask
 
-    def __setitem__(self, index: int, value: int) -> None:
+    def __setitem__(self, index, value) -> None:
+        self.__ensure_writable()
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step == 1:
+                values = self.__to_values(value, max(0, stop - start))
+                _pack_bits(self.array, self.nbits, start, values)
+            else:
+                indices = np.arange(start, stop, step)
+                _scatter_bits(self.array, self.nbits, indices, self.__to_values(value, len(indices)))
+            return
+        if not isinstance(index, (int, np.integer)):
+            indices = self.__to_indices(index)
+            _scatter_bits(self.array, self.nbits, indices, self.__to_values(value, len(indices)))
+            return
+        index, value = int(index), int(value)
         if not 0 <= index < len(self):
             raise IndexError("Invalid index {}".format(index))
         if not 0 <= value <= self.__mask:
@@ -70,36 +111,518 @@ class LitematicaBitArray:
         end_arr_index = ((index + 1) * self.nbits - 1) >> 6
         start_bit_offset = start_offset & 0x3F
         m = (1 << 64) - 1
-        zeroed = self.array[start_arr_index] & ~(self.__mask << start_bit_offset)
+        zeroed = int(self.array[start_arr_index]) & ~(self.__mask << start_bit_offset)
         updated = zeroed | (value & self.__mask) << start_bit_offset
         self.array[start_arr_index] = updated & m
 
         if start_arr_index != end_arr_index:
             end_offset = 64 - start_bit_offset
             j1 = self.nbits - end_offset
-            self.array[end_arr_index] = (self.array[end_arr_index] >> j1 << j1 | (
+            self.array[end_arr_index] = (int(self.array[end_arr_index]) >> j1 << j1 | (
                     value & self.__mask) >> end_offset) & m
 
+    def __to_indices(self, index) -> np.ndarray:
+        index = np.asarray(index)
+        if index.dtype == np.bool_:
+            if index.shape != (len(self),):
+                raise IndexError("Boolean index of shape {} does not match size {}".format(index.shape, len(self)))
+            return np.flatnonzero(index)
+        if index.dtype.kind not in 'iu':
+            raise IndexError("Invalid index {}".format(index))
+        index = index.ravel()
+        if len(index) > 0 and (index.min() < 0 or index.max() >= len(self)):
+            raise IndexError("Invalid index {}".format(index))
+        return index
+
+    def __to_values(self, value, count: int) -> np.ndarray:
+        values = np.broadcast_to(np.asarray(value), (count,))
+        if values.dtype.kind not in 'iu':
+            raise ValueError("Invalid values {}, values must be integers".format(value))
+        if count > 0 and (values.min() < 0 or values.max() > self.__mask):
+            raise ValueError("Invalid values {}, maximum value is {}".format(value, self.__mask))
+        return values
+
+    def __ensure_writable(self) -> None:
+        # Arrays wrapping an NBT buffer are copied on write, they may also be read-only or not use the native byte order
+        if self.__borrowed or not self.array.flags.writeable or not self.array.dtype.isnative:
+            self.array = self.array.astype(np.uint64)
+            self.__borrowed = False
+
     def __len__(self) -> int:
         return self.size
 
     def __iter__(self) -> Generator[int, None, None]:
-        for i in range(len(self)):
-            yield self[i]
+        for start in range(0, len(self), _BULK_CHUNK_SIZE):
+            yield from self[start:start + _BULK_CHUNK_SIZE].tolist()
 
     def __reversed__(self) -> 'LitematicaBitArray':
         arr = LitematicaBitArray(self.size, self.nbits)
-        for i in range(len(self)):
-            arr[i] = self[len(self) - i - 1]
+        arr[:] = self[::-1]
         return arr
 
     def __contains__(self, value: int) -> bool:
-        for v in self:
-            if v == value:
+        if not isinstance(value, (int, np.integer)) or not 0 <= value <= self.__mask:
+            return False
+        for start in range(0, len(self), _BULK_CHUNK_SIZE):
+            if np.any(self[start:start + _BULK_CHUNK_SIZE] == value):
                 return True
         return False
 
 
+def _decode_at(words: np.ndarray, nbits: int, indices: np.ndarray) -> np.ndarray:
+    mask = np.uint64((1 << nbits) - 1)
+    offsets = indices.astype(np.uint64) * np.uint64(nbits)
+    word_indices = offsets >> np.uint64(6)
+    shifts = offsets & np.uint64(0x3F)
+    low = words[word_indices] >> shifts
+    # Shifting in two steps avoids shifting by 64 bits when a value starts at a word boundary.
+    # Bits taken from the next word are masked out for values that do not straddle two words.
+    next_word_indices = np.minimum(word_indices + np.uint64(1), np.uint64(len(words) - 1))
+    high = (words[next_word_indices] << np.uint64(1)) << (np.uint64(63) - shifts)
+    return (low | high) & mask
+
+
+def _encode_at(words: np.ndarray, nbits: int, indices: np.ndarray, values: np.ndarray, clear: bool) -> None:
+    # Indices must be unique and sorted, so values that start in the same word are contiguous
+    mask = np.uint64((1 << nbits) - 1)
+    values = values.astype(np.uint64)
+    offsets = indices.astype(np.uint64) * np.uint64(nbits)
+    word_indices = offsets >> np.uint64(6)
+    shifts = offsets & np.uint64(0x3F)
+
+    groups = np.concatenate(([0], np.flatnonzero(np.diff(word_indices)) + 1))
+    touched = word_indices[groups]
+    if clear:
+        words[touched] &= ~np.bitwise_or.reduceat(mask << shifts, groups)
+    words[touched] |= np.bitwise_or.reduceat(values << shifts, groups)
+
+    # Values that straddle two words have their high bits at the start of the next word
+    straddling = np.flatnonzero(shifts + np.uint64(nbits) > np.uint64(64))
+    if len(straddling) > 0:
+        high_shifts = np.uint64(64) - shifts[straddling]
+        next_word_indices = word_indices[straddling] + np.uint64(1)
+        if clear:
+            words[next_word_indices] &= ~(mask >> high_shifts)
+        words[next_word_indices] |= values[straddling] >> high_shifts
+
+
+def _unpack_bits(words: np.ndarray, nbits: int, start: int, stop: int) -> np.ndarray:
+    """
+    Decodes the values at indices [start; stop[ of a bit array packed into unsigned 64 bits words.
+    """
+    result = np.empty(stop - start, dtype=np.uint32 if nbits <= 32 else np.uint64)
+    for chunk_start in range(start, stop, _BULK_CHUNK_SIZE):
+        chunk_stop = min(chunk_start + _BULK_CHUNK_SIZE, stop)
+        indices = np.arange(chunk_start, chunk_stop, dtype=np.uint64)
+        result[chunk_start - start:chunk_stop - start] = _decode_at(words, nbits, indices)
+    return result
+
+
+def _gather_bits(words: np.ndarray, nbits: int, indices: np.ndarray) -> np.ndarray:
+    """
+    Decodes the values at arbitrary indices of a bit array packed into unsigned 64 bits words.
+    """
+    result = np.empty(len(indices), dtype=np.uint32 if nbits <= 32 else np.uint64)
+    for chunk_start in range(0, len(indices), _BULK_CHUNK_SIZE):
+        chunk = indices[chunk_start:chunk_start + _BULK_CHUNK_SIZE]
+        result[chunk_start:chunk_start + len(chunk)] = _decode_at(words, nbits, chunk)
+    return result
+
+
+def _pack_bits(words: np.ndarray, nbits: int, start: int, values: np.ndarray, clear: bool = True) -> None:
+    """
+    Writes values at indices [start; start + len(values)[ of a bit array packed into native unsigned 64 bits words.
+    Values are expected to fit in nbits bits.
+    Clearing the previous content of the words can be skipped when they are known to be zeroed.
+    """
+    for chunk_start in range(0, len(values), _BULK_CHUNK_SIZE):
+        chunk = values[chunk_start:chunk_start + _BULK_CHUNK_SIZE]
+        indices = np.arange(start + chunk_start, start + chunk_start + len(chunk), dtype=np.uint64)
+        _encode_at(words, nbits, indices, chunk, clear)
+
+
+def _scatter_bits(words: np.ndarray, nbits: int, indices: np.ndarray, values: np.ndarray) -> None:
+    """
+    Writes values at arbitrary indices of a bit array packed into native unsigned 64 bits words.
+    Values are expected to fit in nbits bits.
+    When an index is repeated, the last matching value is kept.
+    """
+    order = np.argsort(indices, kind='stable')
+    indices = indices[order]
+    values = values[order]
+    last = np.append(indices[1:] != indices[:-1], True) if len(indices) > 0 else np.zeros(0, dtype=np.bool_)
+    indices = indices[last]
+    values = values[last]
+    for chunk_start in range(0, len(indices), _BULK_CHUNK_SIZE):
+        chunk = slice(chunk_start, chunk_start + _BULK_CHUNK_SIZE)
+        _encode_at(words, nbits, indices[chunk], values[chunk], clear=True)
+
+
+# Varints store 7 bits per byte, so a 32 bits integer takes up to 5 bytes
+_VARINT_MAX_BYTES = 5
+
+
+def encode_varints(values: np.ndarray) -> np.ndarray:
+    """
+    Encodes non-negative integers as a sequence of LEB128 variable length integers (varints),
+    as used by the Sponge schematic format.
+    Each byte holds 7 bits of the value, least significant bits first,
+    and its highest bit tells whether the value continues in the next byte.
+
+    :param values:  a one dimensional array of integers between 0 and 2^32 - 1
+
+    :returns:       the encoded bytes, as an array of unsigned 8 bits integers
+
+    :raises ValueError: if a value is negative or too large
+    """
+    values = np.asarray(values)
+    if len(values) > 0 and (values.min() < 0 or values.max() >= 1 << 32):
+        raise ValueError("Varint values should be between 0 and 2^32 - 1")
+    chunks = []
+    for chunk_start in range(0, len(values), _BULK_CHUNK_SIZE):
+        chunks.append(_encode_varint_chunk(values[chunk_start:chunk_start + _BULK_CHUNK_SIZE].astype(np.uint32)))
+    if len(chunks) == 1:
+        return chunks[0]
+    return np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.uint8)
+
+
+def decode_varints(data: np.ndarray, count: Optional[int] = None) -> np.ndarray:
+    """
+    Decodes a sequence of LEB128 variable length integers (varints), as used by the Sponge schematic format
+    (see :func:`encode_varints`).
+
+    :param data:    the encoded bytes, as a one dimensional array of 8 bits integers
+    :param count:   the expected number of values, if known
+
+    :returns:       the decoded values, as an array of unsigned 32 bits integers
+
+    :raises ValueError: if the data is truncated, a value does not fit in 32 bits,
+                        or the number of values does not match count
+    """
+    data = np.asarray(data).view(np.uint8)
+    if len(data) > 0 and data[-1] >= 0x80:
+        raise ValueError("Varint data is truncated")
+    total = sum(int(np.count_nonzero(data[chunk_start:chunk_start + _BULK_CHUNK_SIZE] < 0x80))
+                for chunk_start in range(0, len(data), _BULK_CHUNK_SIZE))
+    if count is not None and total != count:
+        raise ValueError("Expected {} varints, found {}".format(count, total))
+    result = np.empty(total, dtype=np.uint32)
+    chunk_start = 0
+    decoded = 0
+    while chunk_start < len(data):
+        chunk = data[chunk_start:chunk_start + _BULK_CHUNK_SIZE]
+        ends = np.flatnonzero(chunk < 0x80)
+        if len(ends) == 0:
+            raise ValueError("Varint is too long")
+        # Cut the chunk after its last complete varint, the next chunk starts with the following one
+        chunk = chunk[:ends[-1] + 1]
+        result[decoded:decoded + len(ends)] = _decode_varint_chunk(chunk, ends)
+        decoded += len(ends)
+        chunk_start += len(chunk)
+    return result
+
+
+def _decode_varint_chunk(data: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    starts = np.empty_like(ends)
+    starts[:1] = 0
+    starts[1:] = ends[:-1] + 1
+    lengths = ends - starts + 1
+    if lengths.max() > _VARINT_MAX_BYTES:
+        raise ValueError("Varint is too long")
+    values = (data[starts] & 0x7f).astype(np.uint64)
+    for k in range(1, _VARINT_MAX_BYTES):
+        present = np.flatnonzero(lengths > k)
+        if len(present) == 0:
+            break
+        values[present] |= (data[starts[present] + k] & 0x7f).astype(np.uint64) << np.uint64(7 * k)
+    if values.max() >= 1 << 32:
+        raise ValueError("Varint does not fit in 32 bits")
+    return values.astype(np.uint32)
+
+
+def _encode_varint_chunk(values: np.ndarray) -> np.ndarray:
+    lengths = np.ones(len(values), dtype=np.int64)
+    for k in range(1, _VARINT_MAX_BYTES):
+        lengths += values >= (1 << (7 * k))
+    offsets = np.cumsum(lengths) - lengths
+    result = np.empty(int(lengths.sum()), dtype=np.uint8)
+    for k in range(_VARINT_MAX_BYTES):
+        present = lengths > k
+        if not present.any():
+            break
+        byte = (values[present] >> np.uint32(7 * k)) & np.uint32(0x7f)
+        byte |= (lengths[present] > k + 1).astype(np.uint32) << np.uint32(7)
+        result[offsets[present] + k] = byte
+    return result
+
+
+class SectionedBlockArray:
+    """
+    A three-dimensional array of palette indices split into cubic sections, similarly to Minecraft chunk sections.
+    Sections that only contain air (index 0) are not allocated,
+    and each allocated section stores its content as indices into its own small palette,
+    so memory usage scales with the content of the array rather than with its volume.
+    It supports the subset of :class:`numpy.ndarray` indexing used by regions:
+    integers, slices with a step of 1 and integer arrays.
+    """
+    shape: tuple[int, int, int]
+    dtype: np.dtype
+    __sections: dict[tuple[int, int, int], '_Section']
+
+    def __init__(self, shape: tuple[int, int, int], dtype: Any = np.uint32) -> None:
+        """
+        :param shape:   the shape of the array
+        :param dtype:   the unsigned integer type values are returned as
+        """
+        self.shape = (shape[0], shape[1], shape[2])
+        self.dtype = np.dtype(dtype)
+        self.__sections = {}
+
+    @property
+    def ndim(self) -> int:
+        return 3
+
+    @property
+    def size(self) -> int:
+        return self.shape[0] * self.shape[1] * self.shape[2]
+
+    @property
+    def section_count(self) -> int:
+        """
+        The number of allocated sections.
+        """
+        return len(self.__sections)
+
+    def astype(self, dtype: Any) -> 'SectionedBlockArray':
+        # Sections store palette indices independently of the type values are returned as,
+        # so they can be shared with the new array
+        other = SectionedBlockArray(self.shape, dtype)
+        other.__sections = self.__sections
+        return other
+
+    def __getitem__(self, key) -> Union[np.integer, np.ndarray]:
+        kind, index, squeezed = self.__normalize(key)
+        if kind == 'scalar':
+            x, y, z = index
+            section = self.__sections.get((x >> 4, y >> 4, z >> 4))
+            if section is None:
+                return self.dtype.type(0)
+            return self.dtype.type(section.palette[section.data[x & 15, y & 15, z & 15]])
+        if kind == 'points':
+            xs, ys, zs = index
+            result = np.zeros(xs.shape, dtype=self.dtype)
+            for key, group in self.__group_points(xs, ys, zs):
+                section = self.__sections.get(key)
+                if section is not None:
+                    local = section.data[xs[group] & 15, ys[group] & 15, zs[group] & 15]
+                    result[group] = section.palette[local]
+            return result
+        result = np.zeros(tuple(stop - start for start, stop in index), dtype=self.dtype)
+        for key, section_box, result_box in self.__overlaps(index):
+            section = self.__sections.get(key)
+            if section is not None:
+                result[result_box] = section.palette[section.data[section_box]]
+        return result[squeezed]
+
+    def __setitem__(self, key, value) -> None:
+        kind, index, squeezed = self.__normalize(key)
+        if kind == 'scalar':
+            x, y, z = index
+            self.__set_scalar(x, y, z, int(value))
+        elif kind == 'points':
+            xs, ys, zs = index
+            values = np.broadcast_to(np.asarray(value), xs.shape)
+            for key, group in self.__group_points(xs, ys, zs):
+                self.__write(key, (xs[group] & 15, ys[group] & 15, zs[group] & 15), values[group])
+        else:
+            shape = tuple(stop - start for start, stop in index)
+            squeezed_shape = np.empty(shape, dtype=np.bool_)[squeezed].shape
+            values = np.broadcast_to(np.asarray(value), squeezed_shape).reshape(shape)
+            for key, section_box, values_box in self.__overlaps(index):
+                self.__write(key, section_box, values[values_box])
+
+    def __array__(self, dtype: Any = None, copy: Optional[bool] = None) -> np.ndarray:
+        result = self[:, :, :]
+        return result if dtype is None else result.astype(dtype)
+
+    def __contains__(self, value: int) -> bool:
+        if value == 0 and len(self.__sections) < self.__section_grid_size():
+            return True  # Sections that are not allocated are filled with air
+        for section in self.__sections.values():
+            local = np.flatnonzero(section.palette == value)
+            if len(local) > 0 and np.isin(section.data, local).any():
+                return True
+        return False
+
+    def bincount(self, minlength: int = 0) -> np.ndarray:
+        """
+        Counts the occurrences of each value, like :func:`numpy.bincount`.
+        """
+        palettes = [section.palette for section in self.__sections.values()]
+        counts = [np.bincount(section.data.ravel(), minlength=len(section.palette))
+                  for section in self.__sections.values()]
+        values = np.concatenate([np.zeros(1, dtype=np.uint32)] + palettes)
+        weights = np.concatenate([np.zeros(1, dtype=np.int64)] + counts)
+        result = np.bincount(values, weights=weights, minlength=minlength).astype(np.int64)
+        result[0] += self.size - sum(section.data.size for section in self.__sections.values())
+        return result
+
+    def count_nonzero(self) -> int:
+        """
+        Counts values that are not zero, like :func:`numpy.count_nonzero`.
+        """
+        return self.size - int(self.bincount(1)[0])
+
+    def remap(self, lut: np.ndarray) -> None:
+        """
+        Replaces every value with its entry in a lookup table.
+        Only section palettes are updated, so this does not depend on the volume of the array,
+        unless zero is mapped to another value, which requires allocating every section.
+        """
+        if lut[0] != 0:
+            grid = tuple(range(ceil(size / 16)) for size in self.shape)
+            for key in product(*grid):
+                if key not in self.__sections:
+                    self.__allocate(key)
+        for key, section in list(self.__sections.items()):
+            section.palette = lut[section.palette].astype(np.uint32)
+            self.__compact(key, section)
+
+    def __set_scalar(self, x: int, y: int, z: int, value: int) -> None:
+        key = (x >> 4, y >> 4, z >> 4)
+        section = self.__sections.get(key)
+        if section is None:
+            if value == 0:
+                return
+            section = self.__allocate(key)
+        matches = np.flatnonzero(section.palette == value)
+        if len(matches) > 0:
+            local = matches[0]
+        else:
+            local = len(section.palette)
+            section.palette = np.append(section.palette, np.uint32(value))
+            section.fit_dtype()
+        section.data[x & 15, y & 15, z & 15] = local
+
+    def __write(self, key: tuple[int, int, int], section_index, values: np.ndarray) -> None:
+        section = self.__sections.get(key)
+        if section is None:
+            if not values.any():
+                return
+            section = self.__allocate(key)
+        unique = np.unique(values)
+        missing = unique[~np.isin(unique, section.palette)]
+        if len(missing) > 0:
+            section.palette = np.concatenate((section.palette, missing.astype(np.uint32)))
+            section.fit_dtype()
+        order = np.argsort(section.palette, kind='stable')
+        section.data[section_index] = order[np.searchsorted(section.palette[order], values)]
+        if not section.palette[section.data].any():
+            del self.__sections[key]
+
+    def __compact(self, key: tuple[int, int, int], section: '_Section') -> None:
+        # Drops unused and duplicate entries from a section's palette, and frees the section if it only has air
+        used, local = np.unique(section.data, return_inverse=True)
+        palette, inverse = np.unique(section.palette[used], return_inverse=True)
+        if len(palette) == 1 and palette[0] == 0:
+            del self.__sections[key]
+            return
+        section.palette = palette.astype(np.uint32)
+        section.data = inverse.ravel()[local.ravel()].reshape(section.data.shape).astype(section.data.dtype)
+        section.fit_dtype()
+
+    def __allocate(self, key: tuple[int, int, int]) -> '_Section':
+        shape = tuple(min(16, size - (k << 4)) for k, size in zip(key, self.shape))
+        section = _Section(shape)
+        self.__sections[key] = section
+        return section
+
+    def __section_grid_size(self) -> int:
+        return ceil(self.shape[0] / 16) * ceil(self.shape[1] / 16) * ceil(self.shape[2] / 16)
+
+    def __normalize(self, key) -> tuple[str, Any, Any]:
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (3 - len(key))
+        if len(key) != 3:
+            raise IndexError("Too many indices for a three-dimensional array")
+        if all(isinstance(k, (int, np.integer)) for k in key):
+            return 'scalar', tuple(self.__check_int(int(k), size) for k, size in zip(key, self.shape)), None
+        if any(isinstance(k, (np.ndarray, list)) for k in key):
+            indices = np.broadcast_arrays(*(np.asarray(k) for k in key))
+            for i, size in zip(indices, self.shape):
+                if i.dtype.kind not in 'iu':
+                    raise IndexError("Only integer arrays are valid indices")
+                if i.size > 0 and (i.min() < -size or i.max() >= size):
+                    raise IndexError("Index out of bounds for axis with size {}".format(size))
+            return 'points', tuple(np.where(i < 0, i + size, i) for i, size in zip(indices, self.shape)), None
+        box = []
+        squeezed = []
+        for k, size in zip(key, self.shape):
+            if isinstance(k, slice):
+                start, stop, step = k.indices(size)
+                if step != 1:
+                    raise IndexError("Only slices with a step of 1 are supported")
+                box.append((start, max(start, stop)))
+                squeezed.append(slice(None))
+            else:
+                k = self.__check_int(int(k), size)
+                box.append((k, k + 1))
+                squeezed.append(0)
+        return 'box', box, tuple(squeezed)
+
+    @staticmethod
+    def __check_int(index: int, size: int) -> int:
+        if not -size <= index < size:
+            raise IndexError("Index {} out of bounds for axis with size {}".format(index, size))
+        return index + size if index < 0 else index
+
+    @staticmethod
+    def __overlaps(box: list[tuple[int, int]]) -> Generator[tuple[tuple[int, int, int], tuple, tuple], None, None]:
+        # Yields the key of every section a box overlaps,
+        # with the matching parts of the box in section and box coordinates
+        ranges = []
+        for start, stop in box:
+            axis = []
+            for k in range(start >> 4, ((stop - 1) >> 4) + 1 if stop > start else start >> 4):
+                lower, upper = max(start, k << 4), min(stop, (k + 1) << 4)
+                axis.append((k, slice(lower - (k << 4), upper - (k << 4)), slice(lower - start, upper - start)))
+            ranges.append(axis)
+        for kx, sx, bx in ranges[0]:
+            for ky, sy, by in ranges[1]:
+                for kz, sz, bz in ranges[2]:
+                    yield (kx, ky, kz), (sx, sy, sz), (bx, by, bz)
+
+    def __group_points(self, xs: np.ndarray, ys: np.ndarray,
+                       zs: np.ndarray) -> Generator[tuple[tuple[int, int, int], tuple], None, None]:
+        # Groups points by section, keeping their relative order so the last write to a position wins
+        grid = (ceil(self.shape[1] / 16), ceil(self.shape[2] / 16))
+        keys = ((xs >> 4) * grid[0] + (ys >> 4)) * grid[1] + (zs >> 4)
+        flat_keys = keys.ravel()
+        order = np.argsort(flat_keys, kind='stable')
+        boundaries = np.flatnonzero(np.diff(flat_keys[order])) + 1
+        for group in np.split(order, boundaries):
+            if len(group) == 0:
+                continue
+            group = np.unravel_index(group, keys.shape)
+            key = int(keys[group][0])
+            yield (key // (grid[0] * grid[1]), key // grid[1] % grid[0], key % grid[1]), group
+
+
+class _Section:
+    __slots__ = ('palette', 'data')
+    palette: np.ndarray
+    data: np.ndarray
+
+    def __init__(self, shape: tuple[int, ...]) -> None:
+        self.palette = np.zeros(1, dtype=np.uint32)
+        self.data = np.zeros(shape, dtype=np.uint8)
+
+    def fit_dtype(self) -> None:
+        if len(self.palette) > 256 and self.data.dtype != np.uint16:
+            self.data = self.data.astype(np.uint16)
+
+
 ValidatorFunction = Callable[[Any, Any], tuple[bool, str]]
 ReactionFunction = Callable[[Any, Any], None]
 
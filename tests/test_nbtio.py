@@ -0,0 +1,116 @@
+import gzip
+from io import BytesIO
+
+import nbtlib
+import numpy as np
+import pytest
+from nbtlib.tag import Base, Compound, List, Int, String, LongArray, IntArray, Float
+
+from litemapy.nbtio import NbtWriter, parse_nbt, read_nbt_file, read_root_tags
+from test_schematics import valid_files
+
+
+def assert_same_tags(expected: Base, actual: Base):
+    assert type(actual) is type(expected)
+    if isinstance(expected, Compound):
+        assert list(actual.keys()) == list(expected.keys())
+        for key in expected:
+            assert_same_tags(expected[key], actual[key])
+    elif isinstance(expected, List):
+        assert len(actual) == len(expected)
+        for expected_item, actual_item in zip(expected, actual):
+            assert_same_tags(expected_item, actual_item)
+    elif isinstance(expected, np.ndarray):
+        # Arrays keep the byte order of the data they were read from
+        assert actual.dtype.str[1:] == expected.dtype.str[1:]
+        assert np.array_equal(actual, expected)
+    else:
+        assert actual == expected
+
+
+def nbt_bytes(tag: nbtlib.File, byteorder: str = "big") -> bytes:
+    buffer = BytesIO()
+    tag.write(buffer, byteorder)
+    return buffer.getvalue()
+
+
+def test_read_nbt_file_matches_nbtlib():
+    for file_name in valid_files:
+        expected = nbtlib.File.load(file_name, True)
+        actual = read_nbt_file(file_name)
+        assert actual.root_name == expected.root_name
+        assert_same_tags(expected, actual)
+
+
+@pytest.mark.parametrize("byteorder", ["big", "little"])
+def test_parse_nbt_round_trip(byteorder):
+    tag = nbtlib.File({
+        "int": Int(-5),
+        "string": String("héllo"),
+        "floats": List[Float]([1.5, -2.25]),
+        "empty": List(),
+        "empty compounds": List[Compound](),
+        "longs": LongArray([1, -1, 2 ** 62]),
+        "ints": IntArray([3, 4]),
+        "nested": List[Compound]([Compound({"a": Int(1)}), Compound()]),
+    }, byteorder=byteorder)
+    assert_same_tags(tag, parse_nbt(nbt_bytes(tag, byteorder), byteorder))
+
+
+def test_parse_nbt_only_shares_block_states_with_the_data():
+    tag = nbtlib.File({
+        "BlockStates": LongArray([1, 2, 3]),
+        "Preview": IntArray([4, 5, 6]),
+        "Entity": Compound({"UUID": IntArray([7, 8, 9, 10])}),
+    })
+    data = nbt_bytes(tag)
+    parsed = parse_nbt(data)
+    assert buffer_owner(parsed["BlockStates"]) is data
+    assert buffer_owner(parsed["Preview"]) is None
+    assert buffer_owner(parsed["Entity"]["UUID"]) is None
+
+
+def buffer_owner(array: np.ndarray):
+    while isinstance(array.base, np.ndarray):
+        array = array.base
+    return array.base
+
+
+def test_parse_nbt_truncated_data():
+    data = nbt_bytes(nbtlib.File({"longs": LongArray([1, 2, 3])}))
+    with pytest.raises(EOFError):
+        parse_nbt(data[:-10])
+
+
+def test_read_root_tags_from_gzip_stream(tmp_path):
+    tag = nbtlib.File({"first": LongArray(np.arange(1000)), "second": Int(3), "third": String("x")})
+    file_name = tmp_path / "test.nbt"
+    tag.save(file_name, gzipped=True)
+    with gzip.open(file_name, "rb") as f:
+        tags = read_root_tags(f, ["second"])
+    assert tags == {"second": Int(3)}
+
+
+@pytest.mark.parametrize("byteorder", ["big", "little"])
+def test_nbt_writer_matches_nbtlib(byteorder):
+    longs = np.arange(-5, 100000, dtype=np.int64)
+    expected = nbtlib.File({
+        "int": Int(7),
+        "nested": Compound({"string": String("abc"), "ints": IntArray([1, 2])}),
+        "longs": LongArray(longs),
+        "unsigned longs": LongArray(longs),
+    }, byteorder=byteorder)
+    buffer = BytesIO()
+    writer = NbtWriter(buffer, byteorder)
+    writer.begin_compound()
+    writer.write_tag("int", Int(7))
+    writer.begin_compound("nested")
+    writer.write_tag("string", String("abc"))
+    writer.write_tag("ints", IntArray([1, 2]))
+    writer.end_compound()
+    writer.write_long_array("longs", longs)
+    writer.write_long_array("unsigned longs", longs.view(np.uint64))
+    writer.end_compound()
+    assert buffer.getvalue() == nbt_bytes(expected, byteorder)
+    with pytest.raises(ValueError):
+        writer.end_compound()
@@ -1,4 +1,15 @@
-from litemapy import Schematic, Region, BlockState
+import asyncio
+import gzip
+import io
+import os
+
+import nbtlib
+import numpy as np
+import pytest
+from nbtlib.tag import Compound, Int, LongArray, String
+from litemapy import Schematic, Region, BlockState, Entity, TileEntity
+from litemapy.nbtio import read_nbt_file
+from litemapy.schematic import CorruptedSchematicError
 from os import walk
 from constants import *
 import helper
@@ -285,3 +296,606 @@ def test_subversion():
         schematic.save(name)
         schematic = Schematic.load(name)
     assert schematic.lm_subversion == 1337
+
+
+def test_setitem_after_palette_edits():
+    region = Region(0, 0, 0, 10, 10, 10)
+    stone = BlockState("minecraft:stone")
+    dirt = BlockState("minecraft:dirt")
+    region[0, 0, 0] = stone
+    region[1, 0, 0] = dirt
+    region.replace(stone, dirt)
+    region[2, 0, 0] = stone
+    region[3, 0, 0] = dirt
+    assert [region[x, 0, 0] for x in range(4)] == [dirt, dirt, stone, dirt]
+    region.filter(lambda b: stone if b == dirt else b)
+    region[4, 0, 0] = dirt
+    assert [region[x, 0, 0] for x in range(5)] == [stone, stone, stone, stone, dirt]
+    assert stone in region
+    assert_valid_palette(region)
+    assert region.palette == (AIR, stone, dirt)
+
+
+def test_optimize_palette_merges_duplicates_and_drops_unused_entries():
+    region = Region(0, 0, 0, 4, 4, 4)
+    states = [BlockState("minecraft:stone"), BlockState("minecraft:dirt"), BlockState("minecraft:oak_log")]
+    for x, state in enumerate(states):
+        region[x, 0, 0] = state
+    region[3, 0, 0] = AIR
+    region.filter(lambda b: states[0] if b == states[2] else b)
+    region[1, 0, 0] = AIR
+    assert region.palette == (AIR, states[0])
+    assert [region[x, 0, 0] for x in range(4)] == [states[0], AIR, states[0], AIR]
+
+
+def test_clean_palette_is_not_optimized_again():
+    region = Region(0, 0, 0, 4, 4, 4)
+    stone = BlockState("minecraft:stone")
+    region[0, 0, 0] = stone
+    scans = []
+    count_palette_usage = region._Region__count_palette_usage
+
+    def counting_palette_usage():
+        scans.append(None)
+        return count_palette_usage()
+
+    region._Region__count_palette_usage = counting_palette_usage
+    assert region.palette == (AIR, stone)
+    assert len(scans) == 0
+    region[0, 0, 0] = AIR
+    assert region.palette == (AIR,)
+    assert region.palette == (AIR,)
+    assert len(scans) == 1
+    region.replace(AIR, stone)
+    assert region.palette == (AIR, stone)
+    assert len(scans) == 2
+
+
+def test_fill():
+    stone = BlockState("minecraft:stone")
+    glass = BlockState("minecraft:glass")
+    for size in (4, -4):
+        region = Region(0, 0, 0, size, size, size)
+        first = (region.min_x(), region.min_y(), region.min_z())
+        region[first] = glass
+        region.fill(first, (region.min_x() + 2, region.min_y() + 1, region.min_z()), stone)
+        for x, y, z in region.block_positions():
+            inside = x - region.min_x() <= 2 and y - region.min_y() <= 1 and z == region.min_z()
+            assert region[x, y, z] == (stone if inside else AIR)
+        mask = np.zeros((4, 1, 4), dtype=bool)
+        mask[1, 0, 3] = True
+        region.fill((region.max_x(), region.max_y(), region.max_z()), (first[0], region.max_y(), first[2]), glass,
+                    mask=mask)
+        assert region[region.min_x() + 1, region.max_y(), region.min_z() + 3] == glass
+        assert len([p for p in region.block_positions() if region[p] == glass]) == 1
+        assert_valid_palette(region)
+    with pytest.raises(IndexError):
+        region.fill((0, 0, 0), (1, 1, 1), stone)
+    with pytest.raises(ValueError):
+        region.fill((0, 0, 0), (-1, -1, -1), stone, mask=np.ones((1, 1, 1), dtype=bool))
+
+
+def test_set_blocks():
+    stone = BlockState("minecraft:stone")
+    dirt = BlockState("minecraft:dirt")
+    region = Region(0, 0, 0, -5, 5, 5)
+    positions = np.array([[0, 0, 0], [-4, 1, 2], [-2, 4, 4], [-4, 1, 2]])
+    region.set_blocks(positions, stone)
+    assert region[0, 0, 0] == region[-4, 1, 2] == region[-2, 4, 4] == stone
+    region.set_blocks(positions, [dirt, stone, dirt, AIR])
+    assert region[0, 0, 0] == dirt
+    assert region[-4, 1, 2] == AIR
+    assert region[-2, 4, 4] == dirt
+    region.set_blocks(positions[:2], np.array([region.palette.index(dirt), 0]))
+    assert region[0, 0, 0] == dirt
+    assert region.palette == (AIR, dirt)
+    assert_valid_palette(region)
+    with pytest.raises(IndexError):
+        region.set_blocks(np.array([[1, 0, 0]]), stone)
+    with pytest.raises(IndexError):
+        region.set_blocks(positions[:1], np.array([2]))
+    with pytest.raises(ValueError):
+        region.set_blocks(positions, [stone])
+
+
+def test_to_array_from_array():
+    stone = BlockState("minecraft:stone")
+    dirt = BlockState("minecraft:dirt")
+    region = Region(0, 0, 0, -3, 4, 5)
+    region[-2, 1, 2] = stone
+    region[0, 3, 4] = dirt
+    blocks, palette = region.to_array()
+    assert blocks.shape == (3, 4, 5)
+    assert palette == (AIR, stone, dirt)
+    assert palette[blocks[0, 1, 2]] == stone
+    assert palette[blocks[2, 3, 4]] == dirt
+    with pytest.raises(ValueError):
+        blocks[0, 0, 0] = 1
+    region[-1, 0, 0] = dirt
+    assert palette[blocks[1, 0, 0]] == dirt
+
+    copy = Region.from_array(blocks, palette, 5, 6, 7)
+    assert (copy.x, copy.y, copy.z) == (5, 6, 7)
+    assert (copy.width, copy.height, copy.length) == (3, 4, 5)
+    assert copy[0, 1, 2] == stone
+    assert copy[2, 3, 4] == dirt
+    storage = np.zeros((2, 2, 2), dtype=np.uint32)
+    shared = Region.from_array(storage, (AIR, stone))
+    shared[1, 1, 1] = stone
+    assert storage[1, 1, 1] == 1
+    with pytest.raises(ValueError):
+        Region.from_array(storage, (stone, AIR))
+    with pytest.raises(ValueError):
+        Region.from_array(storage + 2, (AIR, stone))
+
+
+def test_block_storage_grows_with_palette():
+    region = Region(0, 0, 0, 20, 20, 20)
+    assert region.to_array()[0].dtype == np.uint8
+    states = [BlockState("minecraft:stone_" + str(i)) for i in range(300)]
+    for i, state in enumerate(states):
+        region[i % 20, i // 20, 0] = state
+    blocks, palette = region.to_array()
+    assert blocks.dtype == np.uint16
+    assert len(palette) == 301
+    for i, state in enumerate(states):
+        assert region[i % 20, i // 20, 0] == state
+    with TemporaryDirectory() as temporary_directory:
+        file_path = path.join(temporary_directory, "large-palette.litematic")
+        region.as_schematic().save(file_path)
+        (read_region,) = Schematic.load(file_path).regions.values()
+    assert read_region.to_array()[0].dtype == np.uint16
+    assert all(read_region[i % 20, i // 20, 0] == state for i, state in enumerate(states))
+
+
+def test_sparse_regions_behave_like_dense_regions():
+    stone = BlockState("minecraft:stone")
+    glass = BlockState("minecraft:glass")
+    dense = Region(1, 2, 3, -40, 20, 35)
+    sparse = Region(1, 2, 3, -40, 20, 35, sparse=True)
+    for region in (dense, sparse):
+        region[-3, 4, 5] = stone
+        region.fill((-39, 0, 0), (-20, 1, 34), glass)
+        region.fill((-39, 1, 0), (-20, 1, 34), AIR)
+        region.set_blocks(np.array([[0, 19, 34], [-39, 19, 0]]), [stone, glass])
+        region.replace(glass, stone)
+        region[0, 19, 34] = AIR
+    assert sparse.count_blocks() == dense.count_blocks()
+    assert sparse.palette == dense.palette
+    assert (sparse.to_array()[0] == dense.to_array()[0]).all()
+    assert glass not in sparse
+    assert stone in sparse
+    with TemporaryDirectory() as temporary_directory:
+        file_path = path.join(temporary_directory, "sparse.litematic")
+        sparse.as_schematic().save(file_path)
+        (dense_read,) = Schematic.load(file_path).regions.values()
+        (sparse_read,) = Schematic.load(file_path, sparse=True).regions.values()
+    assert (sparse_read.to_array()[0] == dense.to_array()[0]).all()
+    assert (dense_read.to_array()[0] == dense.to_array()[0]).all()
+    assert sparse_read.palette == dense.palette
+
+
+def test_sparse_regions_replace_air():
+    stone = BlockState("minecraft:stone")
+    glass = BlockState("minecraft:glass")
+    dense = Region(0, 0, 0, 20, 4, -18)
+    sparse = Region(0, 0, 0, 20, 4, -18, sparse=True)
+    for region in (dense, sparse):
+        region[0, 0, 0] = glass
+        region.replace(AIR, stone)
+        region.filter(lambda block: AIR if block == glass else block)
+    assert sparse.palette == dense.palette == (AIR, stone)
+    assert sparse.count_blocks() == dense.count_blocks() == sparse.volume() - 1
+    assert (sparse.to_array()[0] == dense.to_array()[0]).all()
+    assert sparse[19, 3, -17] == stone
+
+
+def test_scratch_file_regions():
+    stone = BlockState("minecraft:stone")
+    states = [BlockState("minecraft:stone_" + str(i)) for i in range(300)]
+    with TemporaryDirectory() as temporary_directory:
+        region = Region(0, 0, 0, 20, 20, -20, scratch_dir=temporary_directory)
+        region.fill((0, 0, 0), (19, 19, -19), stone)
+        for i, state in enumerate(states):
+            region[i % 20, i // 20, 0] = state
+        blocks, palette = region.to_array()
+        assert isinstance(blocks, np.memmap)
+        assert blocks.dtype == np.uint16
+        region.filter(lambda b: AIR if b == stone else b)
+        file_path = path.join(temporary_directory, "scratch.litematic")
+        region.as_schematic().save(file_path)
+        (read_region,) = Schematic.load(file_path, scratch_dir=temporary_directory).regions.values()
+        assert isinstance(read_region.to_array()[0], np.memmap)
+        assert read_region.count_blocks() == len(states)
+        assert all(read_region[i % 20, i // 20, 0] == state for i, state in enumerate(states))
+        with pytest.raises(ValueError):
+            Region(0, 0, 0, 1, 1, 1, sparse=True, scratch_dir=temporary_directory)
+
+
+def test_lazy_regions_are_decoded_on_first_access():
+    for file_path in valid_files:
+        eager = Schematic.load(file_path)
+        lazy = Schematic.load(file_path, lazy=True)
+        assert (lazy.width, lazy.height, lazy.length) == (eager.width, eager.height, eager.length)
+        for name, eager_region in eager.regions.items():
+            lazy_region = lazy.regions[name]
+            assert "_Region__blocks" not in vars(lazy_region)
+            assert lazy_region.volume() == eager_region.volume()
+            assert lazy_region.palette == eager_region.palette
+            assert "_Region__blocks" in vars(lazy_region)
+            assert (lazy_region.to_array()[0] == eager_region.to_array()[0]).all()
+            assert len(lazy_region.entities) == len(eager_region.entities)
+        lazy.to_nbt()
+
+
+def test_failed_save_leaves_existing_file_untouched():
+    schematic = Schematic.load(valid_files[0])
+    nbt = next(iter(schematic.regions.values())).to_nbt()
+    nbt["BlockStates"] = LongArray(nbt["BlockStates"][:1])
+    broken = Schematic(name="Broken", regions={"broken": Region.from_nbt(nbt, lazy=True)})
+    with TemporaryDirectory() as directory:
+        file_path = os.path.join(directory, "existing.litematic")
+        schematic.save(file_path)
+        with open(file_path, "rb") as f:
+            content = f.read()
+        with pytest.raises(ValueError):
+            broken.save(file_path, update_meta=False)
+        with open(file_path, "rb") as f:
+            assert f.read() == content
+        assert os.listdir(directory) == ["existing.litematic"]
+        Schematic.load(file_path)
+
+
+def test_save_through_symlinks_and_bytes_paths():
+    schematic = Schematic.load(valid_files[0])
+    with TemporaryDirectory() as directory:
+        target = os.path.join(directory, "target.litematic")
+        link = os.path.join(directory, "link.litematic")
+        schematic.save(target)
+        os.symlink(target, link)
+        schematic.name = "Through the link"
+        schematic.save(link)
+        assert os.path.islink(link)
+        assert Schematic.load(target).name == "Through the link"
+        schematic.name = "Bytes path"
+        schematic.save(os.fsencode(target))
+        assert Schematic.load(target).name == "Bytes path"
+        assert sorted(os.listdir(directory)) == ["link.litematic", "target.litematic"]
+
+
+def test_lazy_region_decoding_errors_are_raised_on_every_access():
+    nbt = next(iter(Schematic.load(valid_files[0]).regions.values())).to_nbt()
+    nbt["BlockStates"] = LongArray(nbt["BlockStates"][:1])
+    region = Region.from_nbt(nbt, lazy=True)
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            region.palette
+    assert "_Region__palette" not in vars(region)
+
+
+def test_read_metadata_matches_loaded_schematic():
+    for file_name in valid_files:
+        metadata = Schematic.read_metadata(file_name)
+        schematic = Schematic.load(file_name)
+        assert metadata.name == schematic.name
+        assert metadata.author == schematic.author
+        assert metadata.description == schematic.description
+        assert (metadata.width, metadata.height, metadata.length) == \
+               (schematic.width, schematic.height, schematic.length)
+        assert metadata.created == schematic.created
+        assert metadata.modified == schematic.modified
+        assert metadata.lm_version == schematic.lm_version
+        assert metadata.lm_subversion == schematic.lm_subversion
+        assert metadata.mc_version == schematic.mc_version
+        assert metadata.region_count in (None, len(schematic.regions))
+        assert list(metadata.preview) == list(schematic.preview)
+
+
+def test_read_metadata_of_saved_schematic():
+    region = Region(0, 0, 0, 5, 4, 3)
+    region[1, 2, 1] = BlockState("minecraft:stone")
+    schematic = region.as_schematic(name="meta", author="someone", description="a test")
+    with TemporaryDirectory() as temp_dir:
+        for gzipped in (True, False):
+            file_name = temp_dir + "/meta.litematic"
+            schematic.save(file_name, gzipped=gzipped)
+            metadata = Schematic.read_metadata(file_name)
+            assert metadata.name == "meta"
+            assert metadata.author == "someone"
+            assert metadata.description == "a test"
+            assert (metadata.width, metadata.height, metadata.length) == (5, 4, 3)
+            assert metadata.region_count == 1
+            assert metadata.total_blocks == 1
+            assert metadata.total_volume == 60
+            assert metadata.software is not None
+
+
+def test_load_selected_regions():
+    first = Region(0, 0, 0, 2, 2, 2)
+    first[0, 0, 0] = BlockState("minecraft:stone")
+    second = Region(10, 0, 0, 3, 3, 3)
+    second[1, 1, 1] = BlockState("minecraft:dirt")
+    schematic = Schematic(regions={"first": first, "second": second})
+    with TemporaryDirectory() as temp_dir:
+        file_name = temp_dir + "/regions.litematic"
+        schematic.save(file_name)
+        loaded = Schematic.load(file_name, regions=["second"])
+        assert list(loaded.regions) == ["second"]
+        assert loaded.regions["second"][1, 1, 1] == BlockState("minecraft:dirt")
+        loaded = Schematic.load(file_name, regions=lambda name: name.startswith("f"))
+        assert list(loaded.regions) == ["first"]
+        assert loaded.regions["first"][0, 0, 0] == BlockState("minecraft:stone")
+        with pytest.raises(KeyError):
+            Schematic.load(file_name, regions=["third"])
+
+
+def test_load_and_save_with_workers():
+    for file_name in valid_files:
+        serial = Schematic.load(file_name)
+        parallel = Schematic.load(file_name, workers=2)
+        assert list(parallel.regions) == list(serial.regions)
+        for name, region in serial.regions.items():
+            blocks, palette = region.to_array()
+            parallel_blocks, parallel_palette = parallel.regions[name].to_array()
+            assert parallel_palette == palette
+            assert np.array_equal(parallel_blocks, blocks)
+        assert parallel.to_nbt(workers=2) == serial.to_nbt()
+
+
+def test_saved_files_match_to_nbt():
+    with TemporaryDirectory() as temp_dir:
+        for file_name in valid_files:
+            schematic = Schematic.load(file_name)
+            expected = schematic.to_nbt()
+            for gzipped, byteorder in ((True, "big"), (False, "little")):
+                saved_file = temp_dir + "/saved.litematic"
+                schematic.save(saved_file, update_meta=False, gzipped=gzipped, byteorder=byteorder)
+                assert Compound(nbtlib.File.load(saved_file, gzipped, byteorder)) == expected
+
+
+def test_save_compression():
+    schematic = Schematic.load(valid_files[0])
+    expected = schematic.to_nbt()
+    with TemporaryDirectory() as temp_dir:
+        sizes = {}
+        for compression, level in (("gzip", 0), ("gzip", 9), ("zlib", 1), ("none", None), (None, None)):
+            file_name = "{}/{}-{}.litematic".format(temp_dir, compression, level)
+            schematic.save(file_name, update_meta=False, compression=compression, compression_level=level)
+            sizes[compression, level] = os.path.getsize(file_name)
+            assert Schematic.load(file_name).to_nbt() == expected
+        assert sizes["gzip", 9] < sizes["gzip", 0]
+        assert sizes["none", None] > sizes["zlib", 1]
+
+        file_name = temp_dir + "/custom.litematic"
+        schematic.save(file_name, update_meta=False,
+                       compression=lambda f: gzip.GzipFile(fileobj=f, mode="wb", compresslevel=1))
+        assert Schematic.load(file_name).to_nbt() == expected
+
+        with pytest.raises(ValueError):
+            schematic.save(file_name, compression="gzip", compression_level=10)
+        with pytest.raises(ValueError):
+            schematic.save(file_name, compression="none", compression_level=1)
+        with pytest.raises(ValueError):
+            schematic.save(file_name, compression="lzma")
+        # Invalid settings are rejected before the file is overwritten
+        assert Schematic.load(file_name).to_nbt() == expected
+
+        region = next(iter(schematic.regions.values()))
+        for export in (region.to_structure_nbt, region.to_sponge_nbt):
+            file_name = temp_dir + "/export.nbt"
+            exported = export(compression="zlib", compression_level=9)
+            exported.save(file_name)
+            assert read_nbt_file(file_name) == exported
+
+
+class NonSeekableStream(io.RawIOBase):
+
+    def __init__(self, data: bytes = b""):
+        self.source = io.BytesIO(data)
+        self.written = bytearray()
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.source.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def write(self, data):
+        self.written += data
+        return len(data)
+
+
+def test_bytes_and_file_objects():
+    for file_name in valid_files:
+        schematic = Schematic.load(file_name)
+        expected = schematic.to_nbt()
+        for compression in ("gzip", "zlib", "none"):
+            data = schematic.to_bytes(update_meta=False, compression=compression)
+            assert Schematic.from_bytes(data).to_nbt() == expected
+
+            stream = NonSeekableStream()
+            schematic.save(stream, update_meta=False, compression=compression)
+            assert not stream.closed
+            assert Schematic.from_bytes(bytes(stream.written)).to_nbt() == expected
+            assert Schematic.load(NonSeekableStream(data)).to_nbt() == expected
+    with pytest.raises(CorruptedSchematicError):
+        Schematic.from_bytes(b"\x1f\x8bnot really gzip")
+
+
+def test_async_load_and_save():
+    async def convert(file_name: str, output: str):
+        schematic = await Schematic.aload(file_name, lazy=True)
+        await schematic.asave(output, update_meta=False)
+        region = next(iter(schematic.regions.values()))
+        sponge = await region.ato_sponge_nbt(gzipped=False)
+        structure = await region.ato_structure_nbt()
+        return schematic, sponge, structure
+
+    async def convert_all(temp_dir: str):
+        return await asyncio.gather(*(
+            convert(file_name, "{}/{}.litematic".format(temp_dir, i)) for i, file_name in enumerate(valid_files)
+        ))
+
+    with TemporaryDirectory() as temp_dir:
+        results = asyncio.run(convert_all(temp_dir))
+        for i, (file_name, (schematic, sponge, structure)) in enumerate(zip(valid_files, results)):
+            expected = Schematic.load(file_name)
+            assert Schematic.load("{}/{}.litematic".format(temp_dir, i)).to_nbt() == expected.to_nbt()
+            region = next(iter(expected.regions.values()))
+            assert sponge == region.to_sponge_nbt(gzipped=False)
+            assert structure == region.to_structure_nbt()
+
+
+def decode_varints(data) -> list[int]:
+    values, value, shift = [], 0, 0
+    for byte in np.asarray(data).view(np.uint8).tolist():
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            values.append(value)
+            value, shift = 0, 0
+    return values
+
+
+def test_sponge_export_block_data():
+    width, height, length = 7, 5, 6
+    region = Region(0, 0, 0, width, height, length)
+    for i, (x, y, z) in enumerate(region.block_positions()):
+        # Enough different blocks for palette indices to need several bytes
+        region[x, y, z] = BlockState("minecraft:stone_{}".format(i % 200))
+    nbt = region.to_sponge_nbt()
+    palette = {str(state): int(index) for state, index in nbt["Palette"].items()}
+    assert int(nbt["PaletteMax"]) == len(palette) == 201
+    expected = [
+        palette[region[x, y, z].to_block_state_identifier()]
+        for y in range(height) for z in range(length) for x in range(width)
+    ]
+    assert decode_varints(nbt["BlockData"]) == expected
+
+
+def test_sponge_round_trip():
+    region = Region(0, 0, 0, 9, 4, -6)
+    for i, (x, y, z) in enumerate(region.block_positions()):
+        if i % 3:
+            region[x, y, z] = BlockState("minecraft:stone_{}".format(i % 150), facing="north")
+    imported, mc_version = Region.from_sponge_nbt(region.to_sponge_nbt(mc_version=1234))
+    assert mc_version == 1234
+    assert (imported.width, imported.height, imported.length) == (9, 4, 6)
+    assert_valid_palette(imported)
+    for x, y, z in region.block_positions():
+        assert imported[x, y, z - region.min_z()] == region[x, y, z]
+
+    nbt = region.to_sponge_nbt()
+    nbt['BlockData'] = nbt['BlockData'][:-1]
+    with pytest.raises(CorruptedSchematicError):
+        Region.from_sponge_nbt(nbt)
+
+
+def test_schematic_sponge_export_merges_regions():
+    stone, dirt, glass = BlockState("minecraft:stone"), BlockState("minecraft:dirt"), BlockState("minecraft:glass")
+    first = Region(0, 0, 0, 4, 3, 4)
+    first.fill((0, 0, 0), (3, 0, 3), stone)
+    first[1, 1, 1] = glass
+    # Extends towards negative coordinates from (5, 2, 3), and overlaps the first region
+    second = Region(5, 2, 3, -3, -2, -2)
+    second[-2, 0, 0] = dirt
+    second[-1, -1, -1] = glass
+    first.tile_entities.append(TileEntity(Compound({"id": String("minecraft:chest"), "x": Int(1), "y": Int(1),
+                                                    "z": Int(1)})))
+    second.entities.append(Entity("minecraft:pig"))
+    schematic = Schematic(regions={"first": first, "second": second})
+    assert (schematic.width, schematic.height, schematic.length) == (6, 3, 4)
+
+    merged, _ = Region.from_sponge_nbt(schematic.to_sponge_nbt())
+    assert (merged.width, merged.height, merged.length) == (6, 3, 4)
+    expected = {}
+    for region in (first, second):
+        for x, y, z in region.block_positions():
+            if region[x, y, z] != BlockState("minecraft:air"):
+                expected[region.x + x, region.y + y, region.z + z] = region[x, y, z]
+    for x, y, z in merged.block_positions():
+        assert merged[x, y, z] == expected.get((x, y, z), BlockState("minecraft:air"))
+    assert merged[3, 2, 3] == dirt
+    assert [tile_entity.position for tile_entity in merged.tile_entities] == [(1, 1, 1)]
+    assert [entity.position for entity in merged.entities] == [(5.0, 2.0, 3.0)]
+
+
+def test_sponge_v3_round_trip():
+    width, height, length = 3, 2, 4
+    volume = width * height * length
+    biome_ids = np.arange(volume) % 2
+    v3 = nbtlib.File({"Schematic": Compound({
+        "Version": Int(3),
+        "DataVersion": Int(3700),
+        "Width": nbtlib.Short(width),
+        "Height": nbtlib.Short(height),
+        "Length": nbtlib.Short(length),
+        "Offset": nbtlib.IntArray([0, 0, 0]),
+        "Blocks": Compound({
+            "Palette": Compound({"minecraft:air": Int(0), "minecraft:chest[facing=west]": Int(1)}),
+            "Data": nbtlib.ByteArray(np.arange(volume) % 2),
+            "BlockEntities": nbtlib.List[Compound]([Compound({
+                "Id": String("minecraft:chest"),
+                "Pos": nbtlib.IntArray([1, 0, 0]),
+                "Data": Compound({"Lock": String("")}),
+            })]),
+        }),
+        "Biomes": Compound({
+            "Palette": Compound({"minecraft:plains": Int(5), "minecraft:desert": Int(7)}),
+            "Data": nbtlib.ByteArray(np.where(biome_ids == 0, 5, 7)),
+        }),
+        "Entities": nbtlib.List[Compound]([Compound({
+            "Id": String("minecraft:pig"),
+            "Pos": nbtlib.List[nbtlib.Double]([0.5, 1.0, 2.5]),
+            "Data": Compound({"Health": nbtlib.Float(10.0)}),
+        })]),
+    })})
+    region, mc_version = Region.from_sponge_nbt(v3)
+    assert mc_version == 3700
+    assert region[1, 0, 0] == BlockState("minecraft:chest", facing="west")
+    assert region[0, 0, 0] == BlockState("minecraft:air")
+    assert region.tile_entities[0].position == (1, 0, 0)
+    assert region.entities[0].position == (0.5, 1.0, 2.5)
+
+    exported = region.to_sponge_nbt(mc_version=3700, version=3)
+    schematic = exported["Schematic"]
+    assert int(schematic["Version"]) == 3
+    assert "Palette" not in exported and "BlockData" not in exported
+    assert schematic["Blocks"]["BlockEntities"][0]["Id"] == "minecraft:chest"
+    assert schematic["Blocks"]["BlockEntities"][0]["Data"]["Lock"] == ""
+    assert schematic["Entities"][0]["Data"]["Health"] == 10.0
+    biome_palette = {str(name): int(index) for name, index in schematic["Biomes"]["Palette"].items()}
+    biome_names = {index: name for name, index in biome_palette.items()}
+    original_names = {5: "minecraft:plains", 7: "minecraft:desert"}
+    assert [biome_names[i] for i in decode_varints(schematic["Biomes"]["Data"])] == \
+           [original_names[i] for i in np.where(biome_ids == 0, 5, 7)]
+
+    reimported, _ = Region.from_sponge_nbt(exported)
+    for x, y, z in region.block_positions():
+        assert reimported[x, y, z] == region[x, y, z]
+    assert Region.from_sponge_nbt(reimported.to_sponge_nbt(version=3))[0].to_sponge_nbt(version=3) == \
+           reimported.to_sponge_nbt(version=3)
+    assert "Biomes" not in region.to_sponge_nbt(version=2)
+    with pytest.raises(ValueError):
+        region.to_sponge_nbt(version=4)
+
+
+def test_arrays_stop_being_shared_when_the_block_type_is_promoted():
+    blocks = np.zeros((20, 20, 20), dtype=np.uint8)
+    region = Region.from_array(blocks, [BlockState("minecraft:air"), BlockState("minecraft:stone")])
+    view, _ = region.to_array()
+    region[0, 0, 0] = BlockState("minecraft:stone")
+    assert blocks[0, 0, 0] == view[0, 0, 0] == 1
+    for i, (x, y, z) in enumerate(region.block_positions()):
+        if i >= 300:
+            break
+        region[x, y, z] = BlockState("minecraft:stone_{}".format(i))
+    new_view, palette = region.to_array()
+    assert new_view.dtype == np.uint16
+    assert not np.shares_memory(new_view, view) and not np.shares_memory(new_view, blocks)
+    assert palette[new_view[10, 14, 0]] == region[10, 14, 0]
@@ -1,6 +1,9 @@
 import pytest
 import litemapy.storage as storage
 import math
+import numpy as np
+import sys
+from nbtlib import LongArray
 
 TEST_VALUES = 0, 0, 0, 12, 13, 0, 4, 0, 2, 4, 1, 3, 3, 7, 65, 9
 
@@ -34,6 +37,9 @@ def test_litematica_bit_array_in():
         array[i] = e
     assert 13 in array
     assert 15 not in array
+    assert np.uint8(13) in array
+    assert "x" not in array
+    assert None not in array
 
 
 def test_basic_set_get():
@@ -147,3 +153,163 @@ def test_discriminating_dictionary_onadd_onremove():
     dictionary.update({"x": 100, "d": 500, "y": 200})
     assert c.added == 807
     assert c.removed == 17
+
+
+def test_litematica_bit_array_bulk_access_matches_scalar_access():
+    random = np.random.default_rng(1337)
+    for nbits in (2, 5, 13, 32):
+        values = random.integers(0, 1 << nbits, 1000)
+        scalar = storage.LitematicaBitArray(len(values), nbits)
+        for i, e in enumerate(values):
+            scalar[i] = int(e)
+        bulk = storage.LitematicaBitArray(len(values), nbits)
+        bulk[:] = values
+        assert bulk._to_nbt_long_array().tolist() == scalar._to_nbt_long_array().tolist()
+        loaded = storage.LitematicaBitArray.from_nbt_long_array(scalar._to_nbt_long_array(), len(values), nbits)
+        assert loaded[:].tolist() == values.tolist()
+    with pytest.raises(ValueError):
+        storage.LitematicaBitArray.from_nbt_long_array(scalar._to_nbt_long_array(), len(values) + 100, nbits)
+
+
+def test_litematica_bit_array_bulk_access():
+    values = np.array(TEST_VALUES)
+    nbits = math.ceil(math.log(max(TEST_VALUES), 2)) + 1
+    array = storage.LitematicaBitArray(len(TEST_VALUES), nbits)
+    array[:] = values
+    assert array[:].tolist() == list(TEST_VALUES)
+    assert array[3:11:2].tolist() == list(TEST_VALUES[3:11:2])
+    assert array[[15, 0, 4]].tolist() == [TEST_VALUES[15], TEST_VALUES[0], TEST_VALUES[4]]
+    assert array[values > 10].tolist() == [v for v in TEST_VALUES if v > 10]
+    array[values == 0] = 127
+    array[[1, 2]] = [5, 6]
+    array[12:14] = 0
+    expected = [127 if v == 0 else v for v in TEST_VALUES]
+    expected[1:3] = [5, 6]
+    expected[12:14] = [0, 0]
+    assert list(array) == expected
+    assert list(reversed(array)) == expected[::-1]
+    assert 127 in array
+    assert 128 not in array
+    with pytest.raises(IndexError):
+        array[[0, 16]]
+    with pytest.raises(ValueError):
+        array[0:2] = 256
+
+
+def test_litematica_bit_array_from_nbt_long_array_shares_buffer():
+    nbits = math.ceil(math.log(max(TEST_VALUES), 2)) + 1
+    packed = storage.LitematicaBitArray(len(TEST_VALUES), nbits)
+    packed[:] = np.array(TEST_VALUES)
+    long_array = packed._to_nbt_long_array()
+    # Native byte order long arrays are writable, so they would be modified if the buffer was not copied on write
+    for source in (long_array, LongArray(long_array, byteorder=sys.byteorder)):
+        original = source.tolist()
+        array = storage.LitematicaBitArray.from_nbt_long_array(source, len(TEST_VALUES), nbits)
+        assert np.shares_memory(array.array, source)
+        assert list(array) == list(TEST_VALUES)
+        array[0] = 1
+        assert array[0] == 1
+        assert source.tolist() == original
+        assert not np.shares_memory(array.array, source)
+        assert array._to_nbt_long_array()[1:].tolist() == source[1:].tolist()
+
+
+def test_encode_varints():
+    values = np.array([0, 1, 127, 128, 255, 300, 16383, 16384, 2 ** 21, 2 ** 28, 2 ** 32 - 1])
+    expected = bytearray()
+    for value in values.tolist():
+        while True:
+            byte = value & 0x7f
+            value >>= 7
+            expected.append(byte | (0x80 if value else 0))
+            if not value:
+                break
+    encoded = storage.encode_varints(values)
+    assert encoded.dtype == np.uint8
+    assert encoded.tobytes() == bytes(expected)
+    assert len(storage.encode_varints(np.zeros(0, dtype=np.uint32))) == 0
+    with pytest.raises(ValueError):
+        storage.encode_varints(np.array([-1]))
+
+
+def test_decode_varints():
+    values = np.array([0, 1, 127, 128, 255, 300, 16383, 16384, 2 ** 21, 2 ** 28, 2 ** 32 - 1], dtype=np.uint32)
+    encoded = storage.encode_varints(values)
+    decoded = storage.decode_varints(encoded.view(np.int8), len(values))
+    assert decoded.dtype == np.uint32
+    assert np.array_equal(decoded, values)
+    assert len(storage.decode_varints(np.zeros(0, dtype=np.uint8))) == 0
+    with pytest.raises(ValueError):
+        storage.decode_varints(encoded[:-1])
+    with pytest.raises(ValueError):
+        storage.decode_varints(encoded, len(values) + 1)
+    with pytest.raises(ValueError):
+        storage.decode_varints(np.array([0xff, 0xff, 0xff, 0xff, 0x7f], dtype=np.uint8))
+
+
+def test_decode_varints_across_chunks(monkeypatch):
+    # Small chunks make varints straddle chunk boundaries
+    monkeypatch.setattr(storage, "_BULK_CHUNK_SIZE", 7)
+    values = np.random.default_rng(7).integers(0, 1 << 32, 500, dtype=np.uint64) >> \
+        np.random.default_rng(8).integers(0, 32, 500, dtype=np.uint64)
+    encoded = storage.encode_varints(values)
+    assert np.array_equal(storage.decode_varints(encoded, len(values)), values)
+    with pytest.raises(ValueError):
+        storage.decode_varints(np.array([0x80] * 8 + [0], dtype=np.uint8))
+
+
+def test_sectioned_block_array_only_allocates_sections_with_blocks():
+    blocks = storage.SectionedBlockArray((100, 100, 100), np.uint8)
+    blocks[0:20, 0, 0] = 1
+    blocks[50, 50, 50] = 2
+    assert blocks.section_count == 3
+    blocks[:, :, :] = 0
+    assert blocks.section_count == 0
+
+
+def test_sectioned_block_array_matches_ndarray():
+    rng = np.random.default_rng(0)
+    dense = np.zeros((40, 20, 35), dtype=np.uint16)
+    sparse = storage.SectionedBlockArray(dense.shape, np.uint16)
+    for array in (dense, sparse):
+        array[3:30, 5, 2:20] = 4
+        array[0, :, -1] = 300
+        array[17, 19, 34] = 7
+    xs, ys, zs = rng.integers(0, 40, 200), rng.integers(0, 20, 200), rng.integers(0, 35, 200)
+    values = rng.integers(0, 10, 200)
+    for array in (dense, sparse):
+        array[xs, ys, zs] = values
+    assert (np.asarray(sparse) == dense).all()
+    assert (sparse[xs, ys, zs] == dense[xs, ys, zs]).all()
+    assert (sparse[1:25, 3, :] == dense[1:25, 3, :]).all()
+    assert (sparse.bincount(400) == np.bincount(dense.ravel(), minlength=400)).all()
+    assert sparse.count_nonzero() == np.count_nonzero(dense)
+    assert all((value in sparse) == (value in dense) for value in (0, 4, 7, 300, 301))
+
+
+def test_sectioned_block_array_point_writes_with_repeated_indices():
+    blocks = storage.SectionedBlockArray((20, 20, 20), np.uint8)
+    blocks[[1, 1, 17, 1], [2, 2, 3, 2], [3, 3, 4, 3]] = [5, 6, 7, 8]
+    assert blocks[1, 2, 3] == 8
+    assert blocks[17, 3, 4] == 7
+    blocks[[1, 1], [2, 2], [3, 3]] = [9, 0]
+    assert blocks[1, 2, 3] == 0
+    assert blocks.section_count == 1
+
+
+def test_sectioned_block_array_remap():
+    blocks = storage.SectionedBlockArray((20, 20, 20), np.uint8)
+    blocks[0:5, 0, 0] = 1
+    blocks[19, 19, 19] = 2
+    blocks.remap(np.array([0, 2, 0]))
+    assert (blocks[0:5, 0, 0] == 2).all()
+    assert blocks[19, 19, 19] == 0
+    assert blocks.section_count == 1
+    blocks.remap(np.array([3, 0, 1, 0]))
+    assert (blocks[0:5, 0, 0] == 1).all()
+    assert blocks[19, 19, 19] == 3 and blocks[10, 10, 10] == 3
+    assert blocks.section_count == 8
+    assert (blocks.bincount(4) == [0, 5, 0, 8000 - 5]).all()
+    blocks.remap(np.array([0, 0, 0, 0]))
+    assert blocks.section_count == 0
+    assert blocks.count_nonzero() == 0